@@ -3,24 +3,46 @@
 """ Install Go into a local directory. """
 
 import argparse
+import collections
 import errno
 import hashlib
 import io
+import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
 import platform
 import re
 import shutil
+import signal
 import subprocess
 import sys
 import tarfile
 import tempfile
 import textwrap
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 try:
     import urllib2
+    import httplib as http_client
+    import Queue as queue
+    from urlparse import urljoin, urlsplit
 except:
     # Python 3
     import urllib.request as urllib2
+    import http.client as http_client
+    import queue
+    from urllib.parse import urljoin, urlsplit
 
 
 VERSIONS = {
@@ -275,6 +297,10 @@ VERSIONS = {
     '1.25.4': '160043b7f17b6d60b50369436917fda8d5034640ba39ae2431c6b95a889cc98c',
     '1.25.5': '22a5fd0a91efcd28a1b0537106b9959b2804b61f59c3758b51e8e5429c1a954f',
 }
+# sha256 of official binary releases of bootstrap versions, by file name.
+# Filled from the release feed by --update-versions.
+BINARY_VERSIONS = {
+}
 BOOTSTRAP_VERSION = '1.4-bootstrap-20171003'
 BOOTSTRAP_VERSION_1_17_13 = '1.17.13'
 BOOTSTRAP_VERSION_1_20_14 = '1.20.14'
@@ -283,9 +309,28 @@ MIN_VERSION_BUILT_WITH_GO = '1.5'
 MIN_VERSION_BUILT_WITH_GO_1_17_13 = '1.20'
 MIN_VERSION_BUILT_WITH_GO_1_20_14 = '1.22'
 MIN_VERSION_BUILT_WITH_GO_1_22_12 = '1.24'
+# Oldest Go able to build each series ("bootgo" in make.bash).
+MIN_BOOTSTRAP_VERSIONS = [
+    ('1.24', '1.22.6'),
+    ('1.22', '1.20.6'),
+    ('1.20', '1.17.13'),
+    (MIN_VERSION_BUILT_WITH_GO, '1.4'),
+]
+BOOTSTRAP_SEARCH = ['all', 'cache', 'none']
+BINARY_BOOTSTRAP_VERSIONS = [
+    BOOTSTRAP_VERSION_1_17_13,
+    BOOTSTRAP_VERSION_1_20_14,
+    BOOTSTRAP_VERSION_1_22_12,
+]
 RELOCATION_TYPE_42_VERSIONS = ('1.4.1', '1.4.2', '1.4.3')
+# Not extracted unless the build runs tests, see unused_source_dirs.
+UNUSED_SOURCE_DIRS = ('api', 'doc', 'test')
 MIN_VERSION_WITHOUT_INCLUDE = '1.5'
 MIN_VERSION_GOENV_REQUIRED = '1.21.0'
+# Since Go 1.10 the go command finds GOROOT relative to its own binary,
+# so a built toolchain can be moved to any directory.
+MIN_VERSION_RELOCATABLE = '1.10'
+MIN_VERSION_GOCACHE = '1.10'
 
 # cmd/link: support new 386/amd64 relocations
 # It is needed to fix build on Debian 8 Stretch.
@@ -455,6 +500,8 @@ class LineScanner(object):
     def __init__(self, lines):
         self.lines = lines
         self.line_number = 1
+        # Drift of the source from the line numbers of the diff so far.
+        self.offset = 0
 
     def consume_line(self):
         if self.line_number > len(self.lines):
@@ -463,35 +510,58 @@ class LineScanner(object):
             self.line_number += 1
             return self.lines[self.line_number - 2]
 
+# How far from its line number a hunk is looked for, like patch(1) does.
+MAX_HUNK_OFFSET = 100
+
 class Hunk(object):
     def __init__(self, start_line, lines):
         self.start_line = start_line
         self.lines = lines
 
+    def matches(self, old_lines, start_line):
+        index = start_line - 1
+        for line in self.lines:
+            if line[0] in " -":
+                if index >= len(old_lines):
+                    return False
+                if line[1:].strip() != old_lines[index].strip():
+                    return False
+                index += 1
+        return True
+
+    def find_start_line(self, old_lines_scanner):
+        expected = self.start_line + old_lines_scanner.offset
+        for distance in range(MAX_HUNK_OFFSET + 1):
+            for start_line in (expected + distance, expected - distance):
+                if start_line < old_lines_scanner.line_number:
+                    continue
+                if self.matches(old_lines_scanner.lines, start_line):
+                    old_lines_scanner.offset = start_line - self.start_line
+                    return start_line
+        raise PatchError("source is different near line %d" % self.start_line)
+
     def add_new_lines(self, old_lines_scanner, new_lines):
-        while old_lines_scanner.line_number < self.start_line:
+        start_line = self.find_start_line(old_lines_scanner)
+        while old_lines_scanner.line_number < start_line:
             new_lines.append(old_lines_scanner.consume_line())
 
         for line in self.lines:
             first_char, rest = line[0], line[1:]
 
             if first_char in " -":
-                # Deleting or copying a line: it must match what's in the diff.
+                # Deleting or copying a line: it was matched by find_start_line.
                 old_line = old_lines_scanner.consume_line()
-                if rest.strip() != old_line.strip():
-                    raise PatchError("source is different: %s, %s" % (
-                        rest, old_line,
-                    ))
+                if first_char == " ":
+                    new_lines.append(old_line)
 
-            if first_char in " +":
-                # Adding or copying a line: add it to the line list.
+            if first_char == "+":
+                # Adding a line: add it to the line list.
                 new_lines.append(rest)
 
 class FilePatch(object):
     def __init__(self, file_name, lines):
         self.file_name = file_name
         self.hunks = []
-        self.new_lines = []
         hunk_lines = None
         start_line = None
 
@@ -511,27 +581,32 @@ class FilePatch(object):
         if start_line is not None:
             self.hunks.append(Hunk(start_line, hunk_lines))
 
-    def prepare_application(self):
-        if not os.path.exists(self.file_name):
-            raise PatchError("{} doesn't exist".format(self.file_name))
-
-        with open(self.file_name, "r") as handler:
-            source = handler.read()
-
+    def patch_text(self, source):
         old_lines = source.splitlines()
         old_lines_scanner = LineScanner(old_lines)
+        new_lines = []
 
         for hunk in self.hunks:
-            hunk.add_new_lines(old_lines_scanner, self.new_lines)
+            hunk.add_new_lines(old_lines_scanner, new_lines)
 
         while old_lines_scanner.line_number <= len(old_lines):
-            self.new_lines.append(old_lines_scanner.consume_line())
+            new_lines.append(old_lines_scanner.consume_line())
+
+        new_lines.append("")
+        return "\n".join(new_lines)
 
-        self.new_lines.append("")
+    def prepare_application(self):
+        if not os.path.exists(self.file_name):
+            raise PatchError("{} doesn't exist".format(self.file_name))
+
+        with open(self.file_name, "r") as handler:
+            source = handler.read()
+
+        self.new_text = self.patch_text(source)
 
     def apply(self):
         with open(self.file_name, "wt") as handler:
-            handler.write("\n".join(self.new_lines))
+            handler.write(self.new_text)
 
 class Patch(object):
     def __init__(self, src, root_dir):
@@ -604,6 +679,105 @@ def is_build_with_go(version):
     if version_tuple(version) >= version_tuple(MIN_VERSION_BUILT_WITH_GO):
         return BOOTSTRAP_VERSION
 
+def min_bootstrap_version(version):
+    for (series, minimum) in MIN_BOOTSTRAP_VERSIONS:
+        if version_tuple(version) >= version_tuple(series):
+            return minimum
+
+GO_VERSION_LINE = re.compile(r'go version go(\S+) ')
+TOOLCHAIN_VERSIONS = {}
+TOOLCHAIN_VERSIONS_LOCK = threading.Lock()
+
+def toolchain_version(goroot):
+    """ Version of Go in goroot reported by go version, or None. """
+    go = os.path.join(goroot, 'bin', 'go.exe' if os.name == 'nt' else 'go')
+    try:
+        key = (go, os.path.getmtime(go))
+    except OSError:
+        return None
+    with TOOLCHAIN_VERSIONS_LOCK:
+        if key in TOOLCHAIN_VERSIONS:
+            return TOOLCHAIN_VERSIONS[key]
+    env = dict(os.environ)
+    env['GOROOT'] = goroot
+    # Do not let go switch to a toolchain it downloads.
+    env['GOTOOLCHAIN'] = 'local'
+    version = None
+    try:
+        output = subprocess.check_output([go, 'version'], env=env, stderr=subprocess.STDOUT)
+        match = GO_VERSION_LINE.match(output.decode('utf-8', 'replace'))
+        if match:
+            version = match.group(1)
+            if version.startswith('1.4-bootstrap'):
+                version = BOOTSTRAP_VERSION
+            version_tuple(version)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        # Broken toolchains and versions like 1.21rc2 or devel are skipped.
+        version = None
+    with TOOLCHAIN_VERSIONS_LOCK:
+        TOOLCHAIN_VERSIONS[key] = version
+    return version
+
+def bootstrap_candidates(cache_root, search, goroots=()):
+    """ (goroot, cache entry or None) of toolchains to consider as bootstraps.
+
+    search is 'cache' for toolchains built by gohere into the cache and
+    'all' to also consider goroots, GOROOT_BOOTSTRAP, common install
+    locations and go found in PATH.
+    """
+    candidates = []
+    if search == 'none':
+        return candidates
+    if cache_root and os.path.isdir(cache_root):
+        for name in sorted(os.listdir(cache_root)):
+            if name.endswith('_bootstrap'):
+                candidates.append((os.path.join(cache_root, name), name))
+        goroots_dir = os.path.join(cache_root, 'goroots')
+        if os.path.isdir(goroots_dir):
+            for name in sorted(os.listdir(goroots_dir)):
+                if not name.endswith('.staging'):
+                    candidates.append((os.path.join(goroots_dir, name, 'go'), 'goroots/' + name))
+    if search == 'all':
+        others = list(goroots)
+        if os.environ.get('GOROOT_BOOTSTRAP'):
+            others.append(os.environ['GOROOT_BOOTSTRAP'])
+        others += ['/usr/local/go', '/usr/lib/go']
+        sdk = os.path.expanduser(os.path.join('~', 'sdk'))
+        if os.path.isdir(sdk):
+            others += [os.path.join(sdk, name) for name in sorted(os.listdir(sdk))]
+        go = find_program('go.exe' if os.name == 'nt' else 'go')
+        if go:
+            others.append(os.path.dirname(os.path.dirname(os.path.realpath(go))))
+        seen = set()
+        for goroot in others:
+            real = os.path.realpath(goroot)
+            if real not in seen:
+                seen.add(real)
+                candidates.append((goroot, None))
+    return candidates
+
+def find_bootstrap(cache_root, version, search='all', goroots=()):
+    """ Cheapest available toolchain able to build the version.
+
+    Any toolchain at least as new as the minimum bootstrap works, but
+    toolchains newer than the version itself are not trusted with it.
+    The oldest suitable one is closest to the chain gohere would build.
+    Returns (goroot, version of it, cache entry or None) or None.
+    """
+    minimum = min_bootstrap_version(version)
+    if minimum is None:
+        return None
+    best = None
+    for (goroot, entry) in bootstrap_candidates(cache_root, search, goroots):
+        found = toolchain_version(goroot)
+        if found is None:
+            continue
+        if not version_tuple(minimum) <= version_tuple(found) <= version_tuple(version):
+            continue
+        if best is None or version_tuple(found) < version_tuple(best[1]):
+            best = (goroot, found, entry)
+    return best
+
 def get_default_cache():
     # based on hererocks.py
     if os.name == 'nt':
@@ -626,18 +800,172 @@ def get_filename(version):
         version += '.src'
     return 'go%s.tar.gz' % version
 
+DL_URL = 'https://go.dev/dl/'
+
+def set_mirror(url):
+    global DL_URL
+    DL_URL = url.rstrip('/') + '/'
+
 def get_url(version):
-    return 'https://go.dev/dl/%s' % get_filename(version)
+    return DL_URL + get_filename(version)
 
-def download_file(destination, url, echo=None):
-    if echo:
-        echo('wget -O "%s" "%s"' % (destination, url))
-    else:
-        with open(destination, 'wb') as d:
-            request =  urllib2.urlopen(url)
-            shutil.copyfileobj(request, d)
-            request.close()
+BINARY_ARCHS = {
+    'x86_64': 'amd64',
+    'amd64': 'amd64',
+    'aarch64': 'arm64',
+    'arm64': 'arm64',
+    'i386': '386',
+    'i686': '386',
+    'armv6l': 'armv6l',
+    'armv7l': 'armv6l',
+    'ppc64le': 'ppc64le',
+    's390x': 's390x',
+    'riscv64': 'riscv64',
+    'loongarch64': 'loong64',
+}
+
+def binary_platform():
+    """ os-arch of official binary releases for this host, or None. """
+    system = platform.system().lower()
+    arch = BINARY_ARCHS.get(platform.machine().lower())
+    if system in ('linux', 'darwin', 'freebsd') and arch:
+        return '%s-%s' % (system, arch)
+
+def get_binary_filename(version):
+    return 'go%s.%s.tar.gz' % (version, binary_platform())
+
+def has_binary(version):
+    return binary_platform() is not None and get_binary_filename(version) in BINARY_VERSIONS
+
+DOWNLOAD_PIECE_SIZE = 4 * 1024 ** 2
+
+class KeepAliveOpener(object):
+    """ Opens URLs reusing one HTTP(S) connection per host and thread.
+
+    A response must be read to the end before the thread opens another
+    URL on the same host.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def open(self, url, headers=None, redirects=5):
+        (scheme, netloc, path, query, _) = urlsplit(url)
+        if query:
+            path += '?' + query
+        connections = self.local.__dict__.setdefault('connections', {})
+        for attempt in (1, 2):
+            connection = connections.get((scheme, netloc))
+            if connection is None:
+                if scheme == 'https':
+                    connection = http_client.HTTPSConnection(netloc)
+                else:
+                    connection = http_client.HTTPConnection(netloc)
+                connections[(scheme, netloc)] = connection
+            try:
+                connection.request('GET', path or '/', headers=headers or {})
+                response = connection.getresponse()
+                break
+            except (http_client.HTTPException, IOError):
+                # The server may have closed an idle connection.
+                connection.close()
+                del connections[(scheme, netloc)]
+                if attempt == 2:
+                    raise
+        if response.status in (301, 302, 303, 307, 308) and redirects > 0:
+            response.read()
+            location = urljoin(url, response.getheader('Location'))
+            return self.open(location, headers, redirects - 1)
+        if response.status >= 400:
+            response.read()
+            raise IOError('HTTP error %d for %s' % (response.status, url))
+        response.final_url = url
+        return response
+
+def save_response(destination, response):
+    part_name = destination + '.part'
+    with open(part_name, 'wb') as d:
+        shutil.copyfileobj(response, d)
+    response.close()
+    os.rename(part_name, destination)
+
+def probe_ranges(opener, url):
+    """ Return (response, size); size is None if ranges are not served.
+
+    Without ranges the response carries the whole file and is left unread.
+    """
+    response = opener.open(url, {'Range': 'bytes=0-0'})
+    match = re.match(r'bytes 0-0/(\d+)$', response.getheader('Content-Range') or '')
+    if response.status != 206 or not match:
+        return response, None
+    response.read()
+    return response, int(match.group(1))
+
+def download_piece(opener, url, part_name, start, end):
+    length = end - start
+    have = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+    if have > length:
+        os.remove(part_name)
+        have = 0
+    if have == length:
+        return
+    response = opener.open(url, {'Range': 'bytes=%d-%d' % (start + have, end - 1)})
+    if response.status != 206:
+        response.read()
+        raise IOError('%s ignored a range request' % url)
+    with open(part_name, 'ab') as f:
+        shutil.copyfileobj(response, f)
+    if os.path.getsize(part_name) != length:
+        raise IOError('Incomplete download of %s' % part_name)
+
+def download_ranges(destination, url, connections):
+    opener = KeepAliveOpener()
+    response, size = probe_ranges(opener, url)
+    if size is None:
+        logging.info('%s does not support ranges, using one stream', url)
+        save_response(destination, response)
+        return
+    url = response.final_url
+    # Pieces are named after their byte ranges, so pieces left by an
+    # interrupted download are reused and stale ones are recognized.
+    pieces = [
+        ('%s.part-%d-%d' % (destination, start, min(start + DOWNLOAD_PIECE_SIZE, size)),
+         start, min(start + DOWNLOAD_PIECE_SIZE, size))
+        for start in range(0, size, DOWNLOAD_PIECE_SIZE)
+    ]
+    part_names = set(piece[0] for piece in pieces)
+    directory, base = os.path.split(os.path.abspath(destination))
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith(base + '.part-') and path not in part_names:
+            os.remove(path)
+    logging.info('Downloading %d bytes from %s using %d connections', size, url, connections)
+    pool = ThreadPool(connections)
+    try:
+        pool.map(lambda piece: download_piece(opener, url, *piece), pieces)
+    finally:
+        pool.close()
+        pool.join()
+    part_name = destination + '.part'
+    with open(part_name, 'wb') as d:
+        for (piece_name, _, _) in pieces:
+            with open(piece_name, 'rb') as f:
+                shutil.copyfileobj(f, d)
+    os.rename(part_name, destination)
+    for piece_name in part_names:
+        os.remove(piece_name)
+
+def download_file(destination, url, echo=None, connections=1):
+    with trace_span('download', url=url) as span:
+        if echo:
+            echo('wget -O "%s" "%s"' % (destination, url))
+        else:
+            if connections > 1:
+                download_ranges(destination, url, connections)
+            else:
+                save_response(destination, urllib2.urlopen(url))
             logging.info('File %s was downloaded from %s', destination, url)
+            span['bytes'] = os.path.getsize(destination)
 
 def checksum_of_file(fileobj):
     hasher = hashlib.sha256()
@@ -651,41 +979,882 @@ def make_checksum(filepath):
     logging.info('sha256(%s) = %s', filepath, value)
     return value
 
-def test_checksum(filename, version, echo=None):
+def check_checksum(filename, version, observed_checksum):
     expected_checksum = VERSIONS[version]
-    if echo:
-        echo('echo "%s  %s" | sha256sum --check --strict -' % (expected_checksum, filename))
+    if expected_checksum == observed_checksum:
+        logging.info('Checksum of %s is good', filename)
+    else:
+        logging.error(
+            'Checksum of %s is bad.\nExpected %s,\nobserved %s.',
+            filename,
+            expected_checksum,
+            observed_checksum,
+        )
+        sys.exit(1)
+
+def test_checksum(filename, version, echo=None):
+    with trace_span('checksum', file=filename):
+        expected_checksum = VERSIONS[version]
+        if echo:
+            echo('echo "%s  %s" | sha256sum --check --strict -' % (expected_checksum, filename))
+        else:
+            check_checksum(filename, version, make_checksum(filename))
+
+class Tracer(object):
+    """ Collects spans of gohere phases as Chrome trace events.
+
+    The saved file can be opened in Perfetto or chrome://tracing.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def add(self, name, start, end, args):
+        event = {
+            'name': name,
+            'cat': 'gohere',
+            'ph': 'X',
+            'ts': int((start - self.start) * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        logging.info('Trace was written to %s', path)
+
+# Set to a Tracer to record spans.
+TRACER = None
+
+class trace_span(object):
+    """ Context manager recording a span if tracing is enabled.
+
+    It yields the dict of span arguments, so the body can add details
+    such as byte counts or cache hits.
+    """
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self.args
+
+    def __exit__(self, type, value, traceback):
+        if TRACER is not None:
+            if type is not None:
+                self.args['error'] = type.__name__
+            TRACER.add(self.name, self.start, time.time(), self.args)
+
+def lock_file(f, blocking, shared=False):
+    if fcntl is not None:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        fcntl.flock(f.fileno(), flags)
+        return
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return
+        except IOError:
+            if not blocking:
+                raise
+            time.sleep(0.1)
+
+def unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
     else:
-        observed_checksum = make_checksum(filename)
-        if expected_checksum == observed_checksum:
-            logging.info('Checksum of %s is good', filename)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class FileLock(object):
+    """ Lock held through a lock file, across processes.
+
+    The operating system drops the lock if its holder dies. Shared locks
+    need fcntl; with msvcrt they are not taken at all.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.locked = False
+
+    def acquire(self, blocking=True, shared=False):
+        mkdir_p(os.path.dirname(self.path))
+        self.f = open(self.path, 'a+')
+        if shared and fcntl is None:
+            return True
+        try:
+            lock_file(self.f, blocking, shared)
+        except IOError:
+            self.f.close()
+            self.f = None
+            if blocking:
+                raise
+            return False
+        self.locked = True
+        return True
+
+    def downgrade(self):
+        """ Turns the exclusive lock into a shared one. """
+        if fcntl is not None:
+            lock_file(self.f, True, shared=True)
         else:
-            logging.error(
-                'Checksum of %s is bad.\nExpected %s,\nobserved %s.',
-                filename,
-                expected_checksum,
-                observed_checksum,
-            )
+            unlock_file(self.f)
+            self.locked = False
+
+    def release(self):
+        if self.locked:
+            unlock_file(self.f)
+            self.locked = False
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        if self.f is None:
+            self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+LOCKS_DIR = 'locks'
+
+# File descriptors through which --echo scripts hold lock files: one
+# archive at a time and every bootstrap of the chain at once.
+ECHO_ARCHIVE_FD = 3
+ECHO_BOOTSTRAP_FDS = {
+    BOOTSTRAP_VERSION: 6,
+    BOOTSTRAP_VERSION_1_17_13: 7,
+    BOOTSTRAP_VERSION_1_20_14: 8,
+    BOOTSTRAP_VERSION_1_22_12: 9,
+}
+
+def echo_lock_entry(cache_root, name, fd, echo, shared=False):
+    """ Emits taking the lock of the cache entry name on fd. """
+    echo('exec %d>>"%s/%s/%s.lock"' % (fd, cache_root, LOCKS_DIR, name.replace('/', '-')))
+    echo('lock_entry %s%d' % ('-s ' if shared else '', fd))
+
+def entry_lock(cache_root, name):
+    return FileLock(os.path.join(cache_root, LOCKS_DIR, name.replace('/', '-') + '.lock'))
+
+def cache_lock(cache_root, name, shared=False):
+    """ Acquires the lock of the cache entry name.
+
+    The exclusive lock guards creation: the first process creates the
+    entry while others wait here and then reuse it. Users of the entry
+    hold the shared lock, so it is not pruned under them. The lock dies
+    with its holder, so a staging directory found by the next holder
+    was left by a crash and is removed.
+    """
+    lock = entry_lock(cache_root, name)
+    if not lock.acquire(blocking=False, shared=shared):
+        logging.info('Waiting for another gohere to finish %s', name)
+        lock.acquire(shared=shared)
+    return lock
+
+def use_entry(cache_root, name, create=None):
+    """ Shared lock of the cache entry name and whether it existed.
+
+    A missing entry is made by create(path) under the exclusive lock.
+    The caller releases the lock when it no longer needs the entry.
+    """
+    path = os.path.join(cache_root, name)
+    lock = cache_lock(cache_root, name, shared=True)
+    hit = os.path.exists(path)
+    while not hit and create is not None:
+        lock.release()
+        lock = entry_lock(cache_root, name)
+        if lock.acquire(blocking=False):
+            hit = os.path.exists(path)
+            try:
+                if not hit:
+                    create(path)
+            except BaseException:
+                lock.release()
+                raise
+            lock.downgrade()
+            break
+        # Another process is making the entry or is about to. Its maker
+        # keeps a shared lock for as long as it uses the entry, so wait
+        # for the entry under the shared lock, not the exclusive one.
+        lock = cache_lock(cache_root, name, shared=True)
+        hit = os.path.exists(path)
+        if not hit:
+            time.sleep(0.1)
+    if os.path.exists(path):
+        touch_entry(cache_root, name)
+    return lock, hit
+
+class Pins(list):
+    """ Locks of cache entries in use, released on exit. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        for lock in self:
+            lock.release()
+        del self[:]
+
+def staging_dir(path):
+    """ Empty staging directory for path; call it holding the lock of path. """
+    staging = path + '.staging'
+    if os.path.exists(staging):
+        logging.info('Removing %s left by an interrupted run', staging)
+        shutil.rmtree(staging)
+    return staging
+
+ACCESS_INDEX = 'access.json'
+
+# Leftovers of archives and bootstraps being made, by gohere or by an
+# --echo script (suffixed with its pid). The lock of the entry they make
+# guards them.
+PARTIAL_ENTRY = re.compile(r'^(.+_bootstrap|.+\.tar\.gz)\.(staging|download|part)([.-].*)?$')
+
+# Entries used this recently are never pruned.
+PRUNE_GRACE_SECONDS = 600
+
+def touch_entry(cache_root, name):
+    """ Records that the cache entry name was used now. """
+    index_path = os.path.join(cache_root, ACCESS_INDEX)
+    with FileLock(index_path + '.lock'):
+        index = load_json(index_path, {})
+        index[name] = time.time()
+        save_json(index_path, index)
+
+def entry_size(path):
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    size = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+def cache_entries(cache_root):
+    """ Entries of the cache, least recently used first.
+
+    Each entry is a dict with name (relative to cache_root), path, kind,
+    size, used (time of the last use) and lock (name of the entry whose
+    lock guards it).
+    """
+    if not os.path.isdir(cache_root):
+        return []
+    access = load_json(os.path.join(cache_root, ACCESS_INDEX), {})
+    candidates = []
+    for name in os.listdir(cache_root):
+        if name.endswith('.tar.gz'):
+            candidates.append((name, 'archive'))
+        elif name.endswith('_bootstrap'):
+            candidates.append((name, 'bootstrap'))
+        elif PARTIAL_ENTRY.match(name):
+            candidates.append((name, 'partial'))
+    for (subdir, kind) in [('sources', 'sources'), ('goroots', 'goroot'), (GOCACHE_DIR, 'gocache')]:
+        if os.path.isdir(os.path.join(cache_root, subdir)):
+            candidates += [('%s/%s' % (subdir, name), kind)
+                           for name in os.listdir(os.path.join(cache_root, subdir))
+                           if not name.endswith('.staging')]
+    entries = []
+    for (name, kind) in candidates:
+        path = os.path.join(cache_root, name)
+        lock = name
+        if kind == 'partial':
+            lock = PARTIAL_ENTRY.match(name).group(1)
+        try:
+            entries.append({
+                'name': name,
+                'path': path,
+                'kind': kind,
+                'size': entry_size(path),
+                # --echo scripts mark use by the modification time.
+                'used': max(access.get(name, 0), os.path.getmtime(path)),
+                'lock': lock,
+            })
+        except OSError:
+            # Pruned by another process meanwhile.
+            pass
+    entries.sort(key=lambda entry: entry['used'])
+    return entries
+
+def forget_entries(cache_root, names):
+    index_path = os.path.join(cache_root, ACCESS_INDEX)
+    with FileLock(index_path + '.lock'):
+        index = load_json(index_path, {})
+        for name in names:
+            index.pop(name, None)
+        save_json(index_path, index)
+    index_path = os.path.join(cache_root, VERIFIED_INDEX)
+    with FileLock(index_path + '.lock'):
+        index = load_json(index_path, {})
+        for name in names:
+            index.pop(os.path.abspath(os.path.join(cache_root, name)), None)
+        save_json(index_path, index)
+
+def prune_cache(cache_root, max_size):
+    """ Removes least recently used entries until the cache fits max_size.
+
+    Entries in use by any gohere process and recently used ones stay.
+    Returns the list of removed entries.
+    """
+    entries = cache_entries(cache_root)
+    total = sum(entry['size'] for entry in entries)
+    removed = []
+    now = time.time()
+    for entry in entries:
+        if total <= max_size:
+            break
+        if now - entry['used'] < PRUNE_GRACE_SECONDS:
+            continue
+        lock = entry_lock(cache_root, entry['lock'])
+        if not lock.acquire(blocking=False):
+            logging.info('Not pruning %s: it is in use', entry['name'])
+            continue
+        try:
+            if os.path.isdir(entry['path']):
+                shutil.rmtree(entry['path'])
+            elif os.path.exists(entry['path']):
+                os.remove(entry['path'])
+        finally:
+            lock.release()
+        logging.info('Pruned %s (%s)', entry['name'], format_size(entry['size']))
+        total -= entry['size']
+        removed.append(entry)
+    if removed:
+        forget_entries(cache_root, [entry['name'] for entry in removed])
+        count_metric(cache_root, 'gohere_cache_pruned_bytes_total',
+                     sum(entry['size'] for entry in removed))
+    if total > max_size:
+        logging.warning('Cache %s still takes %s', cache_root, format_size(total))
+    return removed
+
+SIZE_UNITS = ['B', 'K', 'M', 'G', 'T']
+
+def parse_size(text):
+    """ Parses sizes like 500M or 20G (powers of 1024). """
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([BKMGT]?)(?:i?B)?$', text.strip(), re.IGNORECASE)
+    if not match:
+        raise ValueError('Bad size: %s' % text)
+    unit = SIZE_UNITS.index(match.group(2).upper() or 'B')
+    return int(float(match.group(1)) * 1024 ** unit)
+
+def format_size(size):
+    unit = 0
+    while size >= 1024 and unit < len(SIZE_UNITS) - 1:
+        size /= 1024.0
+        unit += 1
+    return '%.1f%s' % (size, SIZE_UNITS[unit])
+
+def hash_file(path):
+    """ sha256 of the file, hashed from a memory map without copies. """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # hashlib releases the GIL, so files are hashed in parallel.
+            return hashlib.sha256(m).hexdigest()
+        finally:
+            m.close()
+
+def verify_cache(cache_root, jobs=None):
+    """ Rehashes all cached archives in parallel.
+
+    Returns a list of (entry, status) with status ok, bad or unknown.
+    """
+    expected = dict((get_filename(version), checksum) for (version, checksum) in VERSIONS.items())
+    expected.update(BINARY_VERSIONS)
+    archives = [entry for entry in cache_entries(cache_root) if entry['kind'] == 'archive']
+    pool = ThreadPool(jobs or cpu_budget())
+    try:
+        checksums = pool.map(lambda entry: hash_file(entry['path']), archives)
+    finally:
+        pool.close()
+        pool.join()
+    results = []
+    for (entry, checksum) in zip(archives, checksums):
+        if entry['name'] not in expected:
+            status = 'unknown'
+        elif checksum == expected[entry['name']]:
+            status = 'ok'
+            remember_verified(cache_root, entry['path'], None, checksum)
+        else:
+            status = 'bad'
+        results.append((entry, status))
+    return results
+
+def cache_main(argv):
+    """ gohere cache {ls,stats,prune,verify} """
+    parser = argparse.ArgumentParser(
+        prog='gohere cache',
+        description='Inspect and maintain the cache of gohere',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--cache',
+        type=str,
+        help='Cache for downloaded Go sources',
+        default=get_default_cache(),
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser('ls', help='List entries, least recently used first')
+    commands.add_parser('stats', help='Show sizes of entries by kind')
+    prune = commands.add_parser('prune', help='Remove least recently used entries')
+    prune.add_argument(
+        '--max-size',
+        type=str,
+        required=True,
+        help='Size to shrink the cache to, e.g. 20G',
+    )
+    verify = commands.add_parser('verify', help='Rehash cached archives')
+    verify.add_argument(
+        '--jobs',
+        type=int,
+        help='Archives hashed in parallel (default: CPUs available)',
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'ls':
+        for entry in cache_entries(args.cache):
+            print('%s  %-9s %8s  %s' % (
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['used'])),
+                entry['kind'],
+                format_size(entry['size']),
+                entry['name'],
+            ))
+    elif args.command == 'stats':
+        entries = cache_entries(args.cache)
+        for kind in ['archive', 'bootstrap', 'sources', 'goroot', 'gocache']:
+            selected = [entry for entry in entries if entry['kind'] == kind]
+            print('%-9s %4d entries %8s' % (
+                kind, len(selected), format_size(sum(entry['size'] for entry in selected))))
+        print('%-9s %4d entries %8s' % (
+            'total', len(entries), format_size(sum(entry['size'] for entry in entries))))
+    elif args.command == 'prune':
+        try:
+            max_size = parse_size(args.max_size)
+        except ValueError as e:
+            parser.error(str(e))
+        removed = prune_cache(args.cache, max_size)
+        print('Pruned %d entries, %s' % (
+            len(removed), format_size(sum(entry['size'] for entry in removed))))
+    elif args.command == 'verify':
+        results = verify_cache(args.cache, args.jobs)
+        for (entry, status) in results:
+            print('%-7s %s' % (status, entry['name']))
+        if any(status == 'bad' for (_, status) in results):
             sys.exit(1)
 
+METRICS_FILE = 'metrics.json'
+METRICS = {
+    'gohere_archive_cache_requests_total': (
+        'counter', 'Lookups of source archives in the cache by result.'),
+    'gohere_bootstrap_requests_total': (
+        'counter', 'Bootstrap toolchains needed by result (found, reused, downloaded or built).'),
+    'gohere_downloaded_bytes_total': (
+        'counter', 'Bytes of source archives downloaded.'),
+    'gohere_build_seconds_total': (
+        'counter', 'Seconds spent building Go by version.'),
+    'gohere_build_seconds': (
+        'histogram', 'Duration of Go builds in seconds.'),
+    'gohere_cache_pruned_bytes_total': (
+        'counter', 'Bytes of cache entries removed by pruning.'),
+}
+BUILD_SECONDS_BUCKETS = (60, 120, 300, 600, 1200, 1800, 3600)
+
+def update_metrics(cache_root, update):
+    """ Apply update(metrics) to the metrics file under a lock. """
+    if not cache_root:
+        return
+    path = os.path.join(cache_root, METRICS_FILE)
+    with FileLock(path + '.lock'):
+        metrics = load_json(path, {})
+        update(metrics)
+        save_json(path, metrics)
+
+def count_metric(cache_root, name, value=1, **labels):
+    key = ','.join('%s="%s"' % kv for kv in sorted(labels.items()))
+
+    def update(metrics):
+        series = metrics.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+    update_metrics(cache_root, update)
+
+def observe_build(cache_root, version, seconds):
+    count_metric(cache_root, 'gohere_build_seconds_total', seconds, version=version)
+
+    def update(metrics):
+        histogram = metrics.setdefault('gohere_build_seconds', {
+            'buckets': [0] * len(BUILD_SECONDS_BUCKETS),
+            'sum': 0,
+            'count': 0,
+        })
+        for i, bound in enumerate(BUILD_SECONDS_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    update_metrics(cache_root, update)
+
+def format_metrics(cache_root):
+    """ Metrics in the Prometheus text format. """
+    metrics = load_json(os.path.join(cache_root, METRICS_FILE), {})
+    lines = []
+    for name in sorted(METRICS):
+        (kind, help_text) = METRICS[name]
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        if kind == 'histogram':
+            histogram = metrics.get(name, {})
+            buckets = histogram.get('buckets', [0] * len(BUILD_SECONDS_BUCKETS))
+            for (bound, value) in zip(BUILD_SECONDS_BUCKETS, buckets):
+                lines.append('%s_bucket{le="%s"} %s' % (name, bound, value))
+            lines.append('%s_bucket{le="+Inf"} %s' % (name, histogram.get('count', 0)))
+            lines.append('%s_sum %s' % (name, histogram.get('sum', 0)))
+            lines.append('%s_count %s' % (name, histogram.get('count', 0)))
+        else:
+            for (key, value) in sorted(metrics.get(name, {}).items()):
+                lines.append('%s%s %s' % (name, '{%s}' % key if key else '', value))
+    return '\n'.join(lines)
+
+VERIFIED_INDEX = 'verified.json'
+
+def file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+def load_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+def save_json(path, value):
+    # Readers never see a half-written file.
+    tmp_name = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp_name, 'w') as f:
+        json.dump(value, f, indent=1, sort_keys=True)
+    os.rename(tmp_name, path)
+
+def is_verified(cache_root, path, version, checksum=None):
+    """ Whether the file was verified and has not changed since.
+
+    The file is the source archive of the version unless checksum is given.
+    """
+    index = load_json(os.path.join(cache_root, VERIFIED_INDEX), {})
+    entry = index.get(os.path.abspath(path))
+    expected = {'signature': file_signature(path), 'sha256': checksum or VERSIONS[version]}
+    if entry != expected:
+        return False
+    logging.info('Checksum of %s is known to be good', path)
+    return True
+
+def remember_verified(cache_root, path, version, checksum=None):
+    index_path = os.path.join(cache_root, VERIFIED_INDEX)
+    with FileLock(index_path + '.lock'):
+        index = load_json(index_path, {})
+        index[os.path.abspath(path)] = {
+            'signature': file_signature(path),
+            'sha256': checksum or VERSIONS[version],
+        }
+        save_json(index_path, index)
+
+class HashingReader(object):
+    """ File-like object hashing everything read through it.
+
+    If copy_to is set, the data is also written there, so a single read of
+    the source feeds the hasher, the copy and the consumer at once.
+    """
+
+    def __init__(self, fileobj, copy_to=None):
+        self.fileobj = fileobj
+        self.copy_to = copy_to
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        if self.copy_to is not None:
+            self.copy_to.write(data)
+        self.size += len(data)
+        return data
+
+    def drain(self):
+        for _ in iter(lambda: self.read(1024 ** 2), b''):
+            pass
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
 def is_within_directory(directory, target):
     abs_directory = os.path.abspath(directory)
     abs_target = os.path.abspath(target)
-    prefix = os.path.commonprefix([abs_directory, abs_target])
-    return prefix == abs_directory
+    return abs_target == abs_directory or abs_target.startswith(os.path.join(abs_directory, ''))
 
-def unpack_file(parent_of_goroot, archive_name, echo=None):
-    if echo:
-        echo('tar -C "%s" -xzf "%s"' % (parent_of_goroot, archive_name))
-    else:
-        with tarfile.open(archive_name, 'r:gz') as archive:
-            for member in archive.getmembers():
+def find_program(name):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+
+class ThreadedGunzip(object):
+    """ File-like object decompressing a gzip stream in another thread. """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.chunks = queue.Queue(maxsize=16)
+        self.chunk = b''
+        self.pos = 0
+        self.eof = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._decompress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped:
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _decompress(self):
+        try:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            for chunk in iter(lambda: self.fileobj.read(1024 ** 2), b''):
+                while chunk and not self.stopped:
+                    data = decompressor.decompress(chunk)
+                    chunk = decompressor.unused_data
+                    if chunk:
+                        # Concatenated gzip members.
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    if data:
+                        self._put(data)
+                if self.stopped:
+                    return
+            self._put(decompressor.flush())
+            if not decompressor.eof:
+                raise EOFError('Compressed file ended before the end-of-stream marker')
+            self._put(b'')
+        except Exception as e:
+            self._put(e)
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0 and not self.eof:
+            if self.pos == len(self.chunk):
+                item = self.chunks.get()
+                if isinstance(item, Exception):
+                    self.eof = True
+                    raise item
+                self.chunk = item
+                self.pos = 0
+                if not item:
+                    self.eof = True
+                continue
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.pos + size)
+            parts.append(self.chunk[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return b''.join(parts)
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+
+class PigzGunzip(object):
+    """ File-like object decompressing a gzip stream with pigz. """
+
+    def __init__(self, fileobj, pigz):
+        self.fileobj = fileobj
+        self.process = subprocess.Popen(
+            [pigz, '-dc'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.thread = threading.Thread(target=self._feed)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _feed(self):
+        try:
+            for chunk in iter(lambda: self.fileobj.read(1024 ** 2), b''):
+                self.process.stdin.write(chunk)
+        except IOError:
+            # pigz exited early, its exit code is checked by read().
+            pass
+        finally:
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if not data and self.process.wait() != 0:
+            raise zlib.error('pigz failed with exit code %d' % self.process.returncode)
+        return data
+
+    def close(self):
+        self.process.stdout.close()
+        self.process.wait()
+        self.thread.join()
+
+def open_gunzip(fileobj):
+    pigz = find_program('pigz')
+    if pigz:
+        return PigzGunzip(fileobj, pigz)
+    return ThreadedGunzip(fileobj)
+
+def write_member(path, data, mode, mtime):
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, mode)
+    os.utime(path, (mtime, mtime))
+
+def unused_source_dirs(test=None):
+    """ Top-level directories of GOROOT a build does not need.
+
+    make.bash never reads them and install_go does not install them;
+    only all.bash (test) runs the tests and API checks they hold.
+    """
+    if test:
+        return ()
+    return UNUSED_SOURCE_DIRS
+
+def extract_stream(fileobj, parent_of_goroot, jobs=None, skip_dirs=()):
+    # Decompression, tar parsing and file writes run concurrently, while
+    # members are checked and extracted in a single pass over the stream.
+    # Members under go/<skip_dirs> are passed over without reading them.
+    if jobs is None:
+        jobs = min(8, cpu_budget())
+    # The archive is extracted before its checksum is known, so nothing
+    # may be written outside parent_of_goroot through symlinks: links
+    # must point inside it and every new directory must resolve inside.
+    real_parent = os.path.realpath(parent_of_goroot)
+    gunzip = open_gunzip(fileobj)
+    pool = ThreadPool(jobs)
+    pending = collections.deque()
+    known_dirs = set()
+    dir_members = []
+
+    def check_inside(path):
+        if not is_within_directory(real_parent, os.path.realpath(path)):
+            raise Exception("Attempted Path Traversal in Tar File")
+
+    def wait_pending(limit):
+        while len(pending) > limit:
+            pending.popleft().get()
+
+    def make_dir(path):
+        if path not in known_dirs:
+            mkdir_p(path)
+            check_inside(path)
+            known_dirs.add(path)
+
+    try:
+        with tarfile.open(fileobj=gunzip, mode='r|') as archive:
+            for member in archive:
+                parts = member.name.split('/')
+                if len(parts) > 1 and parts[1] in skip_dirs:
+                    continue
                 member_path = os.path.join(parent_of_goroot, member.name)
                 if not is_within_directory(parent_of_goroot, member_path):
                     raise Exception("Attempted Path Traversal in Tar File")
-            archive.extractall(parent_of_goroot)
+                if member.isdir():
+                    make_dir(member_path)
+                    dir_members.append((member_path, member))
+                elif member.isfile():
+                    make_dir(os.path.dirname(member_path))
+                    data = archive.extractfile(member).read()
+                    pending.append(pool.apply_async(
+                        write_member,
+                        (member_path, data, member.mode, member.mtime),
+                    ))
+                    # Bound the memory held by queued writes.
+                    wait_pending(jobs * 16)
+                else:
+                    make_dir(os.path.dirname(member_path))
+                    if member.issym():
+                        check_inside(os.path.join(os.path.dirname(member_path), member.linkname))
+                    elif member.islnk():
+                        check_inside(os.path.join(parent_of_goroot, member.linkname))
+                    # Links may refer to files which are still queued.
+                    wait_pending(0)
+                    archive.extract(member, parent_of_goroot)
+        wait_pending(0)
+        # Like tarfile, set directory attributes once their contents
+        # are written, deepest first.
+        dir_members.sort(key=lambda item: item[0], reverse=True)
+        for (path, member) in dir_members:
+            os.chmod(path, member.mode)
+            os.utime(path, (member.mtime, member.mtime))
+    finally:
+        pool.close()
+        pool.join()
+        gunzip.close()
+
+def unpack_file(parent_of_goroot, archive_name, echo=None, skip_dirs=()):
+    with trace_span('unpack', file=archive_name):
+        if echo:
+            echo('tar -C "%s" -xzf "%s"' % (parent_of_goroot, archive_name))
+            # tar can not exclude only top-level directories portably:
+            # bsdtar lacks --anchored and unanchored GNU patterns would
+            # also match src/go/doc.
+            if skip_dirs:
+                echo('rm -rf %s' % ' '.join('"%s/go/%s"' % (parent_of_goroot, name) for name in skip_dirs))
+        else:
+            with open(archive_name, 'rb') as f:
+                extract_stream(f, parent_of_goroot, skip_dirs=skip_dirs)
             logging.info('File %s was unpacked to %s', archive_name, parent_of_goroot)
 
+def verify_and_unpack(fileobj, version, parent_of_goroot, filename, copy_to=None, skip_dirs=()):
+    """ Hash, copy and extract the archive in one pass over fileobj.
+
+    The tree is extracted into a staging directory and moved to
+    parent_of_goroot only after the checksum matches VERSIONS[version].
+    """
+    with trace_span('unpack', file=filename) as span:
+        reader = HashingReader(fileobj, copy_to)
+        staging = tempfile.mkdtemp(prefix='.staging', dir=parent_of_goroot)
+        try:
+            extract_error = None
+            try:
+                extract_stream(reader, staging, skip_dirs=skip_dirs)
+            except (tarfile.TarError, EOFError, zlib.error) as e:
+                # Report a bad checksum rather than a broken archive.
+                extract_error = e
+            reader.drain()
+            check_checksum(filename, version, reader.hexdigest())
+            if extract_error is not None:
+                raise extract_error
+            for name in os.listdir(staging):
+                os.rename(
+                    os.path.join(staging, name),
+                    os.path.join(parent_of_goroot, name),
+                )
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        logging.info('File %s was unpacked to %s', filename, parent_of_goroot)
+        span['bytes'] = reader.size
+        return reader.size
+
 def mkdir_p(path):
     # taken from http://stackoverflow.com/a/600612
     try:
@@ -696,208 +1865,1165 @@ def mkdir_p(path):
         else:
             raise
 
-def patch_go(goroot, version, echo=None):
-    if version_tuple(version) < version_tuple(MIN_VERSION_WITHOUT_INCLUDE):
-        libc_h = os.path.join(goroot, 'include', 'libc.h')
-        if echo:
-            echo('sed -i.bak -e "s/struct timespec {/struct timespec_disabled_by_gohere {/g" -- "%s"' % libc_h)
-        else:
-            # https://ci.appveyor.com/project/starius/gohere/build/1.0.5/job/v08nsr6kj98s8xtu
-            logging.info('Patching libc.h to fix conflicting timespec (WIN32)')
-            with open(libc_h) as f:
-                code = f.read()
-            code = code.replace(
-                'struct timespec {',
-                'struct timespec_disabled_by_gohere {',
-            )
-            with open(libc_h, 'w') as f:
-                f.write(code)
+def reflink_tree(src, dst):
+    if platform.system() == 'Linux':
+        args = ['cp', '-a', '--reflink=always', src, dst]
+    elif platform.system() == 'Darwin':
+        args = ['cp', '-Rpc', src, dst]
+    else:
+        return False
+    with open(os.devnull, 'w') as devnull:
+        ok = subprocess.call(args, stderr=devnull) == 0
+    if not ok and os.path.exists(dst):
+        shutil.rmtree(dst)
+    return ok
+
+def copy_file(src, dst):
+    # copy_file_range keeps the data in the kernel and lets filesystems
+    # share extents instead of writing them again.
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                left = os.fstat(fsrc.fileno()).st_size
+                while left > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), left)
+                    if copied == 0:
+                        break
+                    left -= copied
+            shutil.copystat(src, dst)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    shutil.copy2(src, dst)
+
+def copy_tree(src, dst, jobs=None):
+    """ Copy a directory tree, copying files in a thread pool. """
+    files = []
+    dirs_made = []
+    for directory, dirs, names in os.walk(src):
+        target_dir = os.path.normpath(os.path.join(dst, os.path.relpath(directory, src)))
+        mkdir_p(target_dir)
+        dirs_made.append((directory, target_dir))
+        for name in dirs + names:
+            path = os.path.join(directory, name)
+            target = os.path.join(target_dir, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+            elif name in names:
+                files.append((path, target))
+    pool = ThreadPool(jobs or min(8, cpu_budget()))
+    try:
+        pool.map(lambda pair: copy_file(*pair), files)
+    finally:
+        pool.close()
+        pool.join()
+    for (directory, target_dir) in reversed(dirs_made):
+        shutil.copystat(directory, target_dir)
+
+def clone_tree(src, dst):
+    # Hardlinks are not an option: make.bash rewrites generated files
+    # under src/ in place, which would corrupt the original tree.
+    if reflink_tree(src, dst):
+        logging.info('%s was cloned to %s using reflinks', src, dst)
+    else:
+        copy_tree(src, dst)
+        logging.info('%s was copied to %s', src, dst)
+
+INSTALL_MODES = ('auto', 'rename', 'reflink', 'copy')
+
+def choose_install_mode(goroot_final, goroot):
+    if os.stat(goroot).st_dev == os.stat(goroot_final).st_dev:
+        return 'rename'
+    return 'auto'
+
+def install_tree(src, dst, mode):
+    if mode == 'rename':
+        os.rename(src, dst)
+        return
+    if mode in ('auto', 'reflink') and reflink_tree(src, dst):
+        return
+    if mode == 'reflink':
+        logging.error('Failed to clone %s to %s using reflinks', src, dst)
+        sys.exit(1)
+    copy_tree(src, dst)
+
+VLONG_SHIFT = '(vlong)~0 << 32'
+UVLONG_SHIFT = '(uvlong)~0 << 32'
+
+def scan_vlong_shift(goroot):
+    """ Paths relative to goroot of C files containing VLONG_SHIFT. """
+    found = []
+    for directory, _, files in os.walk(goroot):
+        for base in files:
+            if base.endswith('.c'):
+                path = os.path.join(directory, base)
+                with open(path) as f:
+                    if VLONG_SHIFT in f.read():
+                        found.append(os.path.relpath(path, goroot).replace(os.sep, '/'))
+    return sorted(found)
+
+class SourceFix(object):
+    """ A fix of Go sources applied by patch_go.
+
+    It applies to versions from since (inclusive) to until (exclusive),
+    unbounded if None, or only to the listed versions. replacements are
+    (old, new) literal substitutions made in files, given as paths
+    relative to GOROOT (None means files are found by scan(goroot)).
+    patch is a unified diff relative to GOROOT.
+    """
+
+    def __init__(
+        self,
+        name,
+        since=None,
+        until=None,
+        versions=None,
+        files=(),
+        replacements=(),
+        scan=None,
+        patch=None,
+    ):
+        self.name = name
+        self.since = since
+        self.until = until
+        self.versions = versions
+        self.files = files
+        self.replacements = replacements
+        self.scan = scan
+        self.patch = patch
+
+    def applies_to(self, version):
+        if self.versions is not None:
+            return version in self.versions
+        if self.since and version_tuple(version) < version_tuple(self.since):
+            return False
+        if self.until and version_tuple(version) >= version_tuple(self.until):
+            return False
+        return True
+
+    def fingerprint(self):
+        return json.dumps([self.name, self.replacements, self.patch])
+
+    def replace(self, text):
+        for (old, new) in self.replacements:
+            text = text.replace(old, new)
+        return text
+
+SOURCE_FIXES = [
+    # https://ci.appveyor.com/project/starius/gohere/build/1.0.5/job/v08nsr6kj98s8xtu
+    SourceFix(
+        'libc-timespec',
+        until=MIN_VERSION_WITHOUT_INCLUDE,
+        files=['include/libc.h'],
+        replacements=[('struct timespec {', 'struct timespec_disabled_by_gohere {')],
+    ),
     # Fix "shifting a negative signed value is undefined" on clang.
     # See https://travis-ci.org/starius/gohere/jobs/169812907
-    if echo:
-        echo('find "%s" -name "*.c" -print0 | xargs -0 -I cfile sed -i.bak -e "s/(vlong)~0 << 32/(uvlong)~0 << 32/g" -- cfile' % goroot)
-    else:
-        for directory, _, files in os.walk(goroot):
-            for base in files:
-                if base.endswith('.c'):
-                    path = os.path.join(directory, base)
-                    with open(path) as f:
-                        t = f.read()
-                    if '(vlong)~0 << 32' in t:
-                        logging.info('Patching %s to fix (vlong)~0 << 32', path)
-                        t = t.replace('(vlong)~0 << 32', '(uvlong)~0 << 32')
-                        with open(path, 'w') as f:
-                            f.write(t)
+    # Only the 1.4 bootstrap still has vlong. Its files are not listed
+    # here, they are scanned for (once per tree with --source-cache).
+    SourceFix(
+        'vlong-shift',
+        until=MIN_VERSION_WITHOUT_INCLUDE,
+        files=None,
+        replacements=[(VLONG_SHIFT, UVLONG_SHIFT)],
+        scan=scan_vlong_shift,
+    ),
     # Patch Go 1.4 to prevent https://github.com/golang/go/issues/13896
     # The patch is not applicable to Go 1.4 because line numbers shift.
-    if version in RELOCATION_TYPE_42_VERSIONS:
-        if echo:
-            echo('cd "%s" && patch -p0 -u << EOF\n%s\nEOF' % (goroot, RELOCATION_TYPE_42_PATCH))
-        else:
-            logging.info('Patching to "fix unknown relocation type 42"')
-            err = Patch(RELOCATION_TYPE_42_PATCH, goroot).apply()
-            if err is not None:
-                raise Exception(err)
+    SourceFix(
+        'relocation-type-42',
+        versions=RELOCATION_TYPE_42_VERSIONS,
+        patch=RELOCATION_TYPE_42_PATCH,
+    ),
     # Fix "implicit conversion from 'int' to 'char' changes" errors.
     # https://travis-ci.org/starius/gohere/jobs/323022483#L2346
-    if version_tuple(version) < version_tuple(BOOTSTRAP_VERSION):
-        dwarf_c = os.path.join(goroot, 'src', 'cmd', 'ld', 'dwarf.c')
-        if echo:
-            echo('sed -i.bak -e "s/DW_CFA_offset/((char)(DW_CFA_offset))/g" -- "%s"' % dwarf_c)
-            echo('sed -i.bak -e "s/DW_OP_call_frame_cfa/((char)(DW_OP_call_frame_cfa))/g" -- "%s"' % dwarf_c)
-        else:
-            logging.info('Patching dwarf.c to fix implicit conversion errors')
-            with open(dwarf_c) as f:
-                code = f.read()
-            code = code.replace('DW_CFA_offset', '((char)(DW_CFA_offset))')
-            code = code.replace('DW_OP_call_frame_cfa', '((char)(DW_OP_call_frame_cfa))')
-            with open(dwarf_c, 'w') as f:
-                f.write(code)
-
-def build_go(goroot_final, goroot, goroot_bootstrap=None, test=False, echo=None):
-    action = 'all' if test else 'make'
-    cwd = os.path.join(goroot, 'src')
-    if not echo:
-        cwd = os.path.abspath(cwd)
-    if os.name == 'nt':
-        # Otherwise Windows can not find the batch file
-        args = [os.path.join(cwd, '%s.bat' % action)]
-    else:
-        args = ['./%s.bash' % action]
-    if echo:
-        echo(
-            'cd "%s" && GOROOT_FINAL="%s" GOROOT_BOOTSTRAP="%s" %s | grep "Installed Go"' %
-            (cwd, goroot_final, goroot_bootstrap or '', ' '.join(args))
-        )
-    else:
-        env = os.environ.copy()
-        env['GOROOT_FINAL'] = goroot_final
-        if goroot_bootstrap:
-            env['GOROOT_BOOTSTRAP'] = goroot_bootstrap
-            logging.info('Go bootstrap is %s', goroot_bootstrap)
-        logging.info('Building Go in %s', cwd)
-        go_process = subprocess.Popen(
-            args,
-            cwd=cwd,
-            env=env,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        (stdout_data, stderr_data) = go_process.communicate()
-        logging.info('Exit code is %d', go_process.returncode)
-        if not isinstance(stdout_data, str):
-            stdout_data = stdout_data.decode()
-        if not isinstance(stderr_data, str):
-            stderr_data = stderr_data.decode()
-        if go_process.returncode != 0 or 'Installed Go' not in stdout_data:
-            logging.error('Failed to build Go.')
-            logging.error('stdout: %s', stdout_data)
-            logging.error('stderr: %s', stderr_data)
-            sys.exit(1)
-        logging.info('Go was built in %s', goroot)
+    SourceFix(
+        'dwarf-char',
+        until=BOOTSTRAP_VERSION,
+        files=['src/cmd/ld/dwarf.c'],
+        replacements=[
+            ('DW_CFA_offset', '((char)(DW_CFA_offset))'),
+            ('DW_OP_call_frame_cfa', '((char)(DW_OP_call_frame_cfa))'),
+        ],
+    ),
+]
 
-def install_go(goroot_final, goroot, version, echo=None):
-    if echo:
-        echo('mkdir -p "%s"' % goroot_final)
-    else:
-        mkdir_p(goroot_final)
-    dirs = ['src', 'bin', 'pkg', 'misc']
-    if version_tuple(version) < version_tuple(MIN_VERSION_WITHOUT_INCLUDE):
-        dirs.append('include')
-    if echo:
-        dirs2 = ['"%s"' % os.path.join(goroot, d) for d in dirs]
-        echo('cp -a %s "%s"' % (' '.join(dirs2), goroot_final))
-    else:
-        for subdir in dirs:
-            src = os.path.join(goroot, subdir)
-            dst = os.path.join(goroot_final, subdir)
-            shutil.copytree(src, dst)
-    if version_tuple(version) >= version_tuple(MIN_VERSION_GOENV_REQUIRED):
-        # Copy go.env file to fix "go: GOPROXY list is not the empty string, but contains no entries".
-        # Disable dangerous settings.
-        goenv_src = os.path.join(goroot, 'go.env')
-        goenv_dst = os.path.join(goroot_final, 'go.env')
-        if echo:
-            echo('echo "Copying go.env file to %s"' % goroot_final)
-            echo('cp %s %s' % (goenv_src, goenv_dst))
-            echo('echo "Disabling dangerous settings in go.env"')
-            echo('sed -i.bak -e "s/GOPROXY=.*/GOPROXY=direct/" -- "%s"' % goenv_dst)
-            echo('sed -i.bak -e "s/GOSUMDB=.*/GOSUMDB=off/" -- "%s"' % goenv_dst)
-            echo('sed -i.bak -e "s/GOTOOLCHAIN=.*/GOTOOLCHAIN=local/" -- "%s"' % goenv_dst)
-        else:
-            logging.info('Copying go.env file to %s', goroot_final)
-            with io.open(goenv_src) as f:
-                goenv_content = f.read()
-            logging.info('Disabling dangerous settings in go.env')
-            goenv_content = re.sub(r'GOPROXY=\S*', 'GOPROXY=direct', goenv_content)
-            goenv_content = re.sub(r'GOSUMDB=\S*', 'GOSUMDB=off', goenv_content)
-            goenv_content = re.sub(r'GOTOOLCHAIN=\S*', 'GOTOOLCHAIN=local', goenv_content)
-            with io.open(goenv_dst, 'w', newline='\n') as f:
-                f.write(goenv_content)
-    if echo:
-        echo('echo "Go was installed to %s"' % goroot_final)
+def source_fixes(version):
+    return [fix for fix in SOURCE_FIXES if fix.applies_to(version)]
+
+def sed_escape(text):
+    return re.sub(r'([/&\\.*\[\]^$])', r'\\\1', text)
+
+def sed_expressions(replacements):
+    return ' '.join(
+        '-e "s/%s/%s/g"' % (sed_escape(old), sed_escape(new))
+        for (old, new) in replacements
+    )
+
+def echo_source_fix(fix, goroot, version, echo):
+    if fix.replacements:
+        files = fix.files
+        if files is None:
+            # Only files containing the text are given to sed, rather
+            # than every C file. Options are shared by GNU and BSD grep.
+            echo('grep -rlF --include="*.c" %s -- "%s" | while IFS= read -r cfile; do sed -i.bak %s -- "$cfile"; done' % (
+                ' '.join('-e "%s"' % old for (old, _) in fix.replacements),
+                goroot,
+                sed_expressions(fix.replacements),
+            ))
+        elif files:
+            echo('sed -i.bak %s -- %s' % (
+                sed_expressions(fix.replacements),
+                ' '.join('"%s/%s"' % (goroot, name) for name in files),
+            ))
+    if fix.patch:
+        echo('cd "%s" && patch -p0 -u << EOF\n%s\nEOF' % (goroot, fix.patch))
+
+def plan_source_fixes(goroot, version):
+    """ Edits of each file by the fixes of the version, in SOURCE_FIXES order.
+
+    Returns an ordered dict from paths relative to goroot to lists of
+    (fix name, function from old text to new text).
+    """
+    plan = collections.OrderedDict()
+    for fix in source_fixes(version):
+        if fix.replacements:
+            files = fix.files
+            if files is None:
+                logging.info('Scanning C files of Go %s for %s', version, fix.name)
+                files = fix.scan(goroot)
+            for name in files:
+                plan.setdefault(name, []).append((fix.name, fix.replace))
+        if fix.patch:
+            for file_patch in Patch(fix.patch, '').file_patches:
+                plan.setdefault(file_patch.file_name, []).append((fix.name, file_patch.patch_text))
+    return plan
+
+def patch_go(goroot, version, echo=None):
+    with trace_span('patch', version=version):
+        if echo:
+            for fix in source_fixes(version):
+                echo_source_fix(fix, goroot, version, echo)
+            return
+        plan = plan_source_fixes(goroot, version)
+        if not plan:
+            return
+
+        def prepare(item):
+            # Every fix of the file is applied to one read of it.
+            (name, edits) = item
+            path = os.path.join(goroot, *name.split('/'))
+            if not os.path.exists(path):
+                raise PatchError("{} doesn't exist".format(path))
+            with open(path) as f:
+                text = f.read()
+            for (_, edit) in edits:
+                text = edit(text)
+            return (path, edits, text)
+
+        def write(prepared):
+            (path, edits, text) = prepared
+            logging.info('Patching %s (%s)', path, ', '.join(fix for (fix, _) in edits))
+            with open(path, 'w') as f:
+                f.write(text)
+
+        # Nothing is written unless every file can be patched.
+        pool = ThreadPool(min(len(plan), 8, cpu_budget()))
+        try:
+            prepared = pool.map(prepare, plan.items())
+            pool.map(write, prepared)
+        finally:
+            pool.close()
+            pool.join()
+
+def patch_fingerprint(version):
+    hasher = hashlib.sha256()
+    for fix in source_fixes(version):
+        hasher.update(fix.fingerprint().encode())
+    return hasher.hexdigest()[:16]
+
+def cgroup_cpu_quota():
+    """ CPU limit of the cgroup of this process, rounded up, or None. """
+    limits = []
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                (_, controllers, path) = line.strip().split(':', 2)
+                if controllers == '':
+                    # cgroup v2: the limit of any ancestor applies.
+                    while True:
+                        cpu_max = os.path.join('/sys/fs/cgroup', path.lstrip('/'), 'cpu.max')
+                        if os.path.exists(cpu_max):
+                            with open(cpu_max) as f2:
+                                (quota, period) = f2.read().split()[:2]
+                            if quota != 'max':
+                                limits.append(float(quota) / float(period))
+                        if path in ('/', ''):
+                            break
+                        path = os.path.dirname(path)
+    except (IOError, ValueError):
+        pass
+    try:
+        # cgroup v1, as seen from inside a container.
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0:
+            limits.append(float(quota) / period)
+    except (IOError, ValueError):
+        pass
+    if limits:
+        return max(1, int(math.ceil(min(limits))))
+
+def cpu_budget():
+    """ Number of CPUs this process may use. """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
     else:
-        logging.info('Go was installed to %s', goroot_final)
+        cpus = multiprocessing.cpu_count()
+    quota = cgroup_cpu_quota()
+    if quota:
+        cpus = min(cpus, quota)
+    return cpus
 
-def build_race(goroot, echo=None):
-    # See https://github.com/golang/go/issues/20512
-    go_binary = os.path.join(goroot, 'bin', 'go')
-    args = [go_binary, 'install', '-v', '-race', 'std']
-    if echo:
-        echo(' '.join(args))
+# Rough peak memory of one make.bash run.
+BUILD_MEMORY = 1536 * 1024 * 1024
+
+def memory_budget():
+    """ Bytes of memory available for builds, or None if unknown. """
+    limits = []
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    limits.append(int(line.split()[1]) * 1024)
+    except (IOError, ValueError):
+        pass
+    for (limit_file, usage_file) in [
+        ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+        ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes'),
+    ]:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            with open(usage_file) as f:
+                usage = int(f.read())
+            if limit != 'max':
+                limits.append(max(0, int(limit) - usage))
+        except (IOError, ValueError):
+            pass
+    if limits:
+        return min(limits)
+
+IONICE_CLASSES = {'best-effort': '2', 'idle': '3'}
+
+def limit_env(env, jobs):
+    # make.bash and all.bash are limited by GOMAXPROCS alone: they run
+    # cmd/dist with GOFLAGS cleared, so -p can not be passed to them.
+    # build_race passes -p to go install itself.
+    if jobs:
+        env['GOMAXPROCS'] = str(jobs)
+    return env
+
+def priority_prefix(nice=None, ionice=None, echo=None):
+    prefix = []
+    if ionice and (echo or find_program('ionice')):
+        prefix += ['ionice', '-c', IONICE_CLASSES[ionice]]
+    if nice and (echo or find_program('nice')):
+        prefix += ['nice', '-n', str(nice)]
+    return prefix
+
+def limit_env_echo(jobs):
+    if not jobs:
+        return ''
+    return 'GOMAXPROCS=%d ' % jobs
+
+BUILD_OUTPUT_LINES = 500
+FAILURE_LINE = re.compile(r'^(FAIL\s|--- FAIL|go tool dist: FAILED)')
+PACKAGE_LINE = re.compile(r'^[\w.-]+(/[\w.-]+)*$')
+
+def classify_line(line):
+    if FAILURE_LINE.match(line):
+        return ('failure', line)
+    if line.startswith('Building ') or line.startswith('##### '):
+        return ('stage', line.strip('# '))
+    if PACKAGE_LINE.match(line):
+        return ('package', line)
+
+def log_progress(event, value):
+    if event == 'package':
+        logging.debug('Built %s', value)
     else:
-        logging.info('Building Go race in %s', goroot)
-        go_process = subprocess.Popen(
-            args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        (stdout_data, stderr_data) = go_process.communicate()
-        logging.info('Exit code is %d', go_process.returncode)
-        if not isinstance(stdout_data, str):
-            stdout_data = stdout_data.decode()
-        if not isinstance(stderr_data, str):
-            stderr_data = stderr_data.decode()
-        if go_process.returncode != 0:
-            logging.error('Failed to build Go.')
-            logging.error('stdout: %s', stdout_data)
-            logging.error('stderr: %s', stderr_data)
-            sys.exit(1)
+        logging.info('Build %s: %s', event, value)
 
-def get_from_cache_or_download(cache_root, version, tmp_dir, echo=None):
+def kill_build(process):
+    if os.name == 'nt':
+        process.kill()
+    else:
+        # make.bash runs the compilers as its children.
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+def run_build(args, marker=None, progress=log_progress, fail_fast=False, **kwargs):
+    """ Run a build command, streaming its stdout and stderr line by line.
+
+    Only the last BUILD_OUTPUT_LINES lines are kept. progress(event, value)
+    is called for 'stage', 'package' and 'failure' lines. The build is
+    killed if progress returns False, or on a failure if fail_fast is set.
+    Returns the exit code, whether marker was seen and the kept lines.
+    """
+    if os.name != 'nt':
+        # A process group of its own, so that kill_build reaches the
+        # compilers too. start_new_session is missing in Python 2.
+        kwargs['preexec_fn'] = os.setsid
+    process = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **kwargs
+    )
+    lines = queue.Queue()
+
+    def read(stream, name):
+        for line in iter(stream.readline, b''):
+            lines.put((name, line))
+        stream.close()
+        lines.put((name, None))
+
+    readers = [
+        threading.Thread(target=read, args=(process.stdout, 'stdout')),
+        threading.Thread(target=read, args=(process.stderr, 'stderr')),
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    output = collections.deque(maxlen=BUILD_OUTPUT_LINES)
+    seen_marker = False
+    killed = False
+    open_streams = len(readers)
+    try:
+        while open_streams:
+            (name, line) = lines.get()
+            if line is None:
+                open_streams -= 1
+                continue
+            line = line.decode('utf-8', 'replace').rstrip()
+            output.append('%s: %s' % (name, line))
+            if marker and marker in line:
+                seen_marker = True
+            event = classify_line(line)
+            if event and not killed:
+                keep_going = progress(*event) if progress else None
+                if keep_going is False or (fail_fast and event[0] == 'failure'):
+                    logging.error('Stopping the build after: %s', line)
+                    kill_build(process)
+                    killed = True
+    except BaseException:
+        kill_build(process)
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+        process.wait()
+    return process.returncode, seen_marker, list(output)
+
+def report_build_failure(returncode, output):
+    logging.error('Failed to build Go, exit code is %d.', returncode)
+    logging.error('Last %d lines of output:\n%s', len(output), '\n'.join(output))
+    sys.exit(1)
+
+def build_go(
+    goroot_final,
+    goroot,
+    goroot_bootstrap=None,
+    test=False,
+    echo=None,
+    jobs=None,
+    nice=None,
+    ionice=None,
+    progress=log_progress,
+    fail_fast=False,
+    gocache=None,
+):
+    with trace_span('build', goroot=goroot, test=bool(test)):
+        action = 'all' if test else 'make'
+        cwd = os.path.join(goroot, 'src')
+        if not echo:
+            cwd = os.path.abspath(cwd)
+        if os.name == 'nt':
+            # Otherwise Windows can not find the batch file
+            args = [os.path.join(cwd, '%s.bat' % action)]
+        else:
+            args = ['./%s.bash' % action]
+        args = priority_prefix(nice, ionice, echo) + args
+        if echo:
+            # The output goes to a file instead of through a pipe, so a
+            # failing build stops the script and shows how it failed.
+            log = '%s/build.log' % goroot
+            echo(
+                'cd "%s" && GOROOT_FINAL="%s" GOROOT_BOOTSTRAP="%s" %s%s > "%s" 2>&1 || { tail -n %d "%s"; exit 1; }' %
+                (cwd, goroot_final, goroot_bootstrap or '', limit_env_echo(jobs), ' '.join(args), log, BUILD_OUTPUT_LINES, log)
+            )
+            echo('grep "Installed Go" "%s"' % log)
+        else:
+            env = limit_env(os.environ.copy(), jobs)
+            env['GOROOT_FINAL'] = goroot_final
+            if gocache:
+                env['GOCACHE'] = gocache
+            if goroot_bootstrap:
+                env['GOROOT_BOOTSTRAP'] = goroot_bootstrap
+                logging.info('Go bootstrap is %s', goroot_bootstrap)
+            logging.info('Building Go in %s using %s CPUs', cwd, jobs or 'all')
+            (returncode, installed, output) = run_build(
+                args,
+                marker='Installed Go',
+                progress=progress,
+                fail_fast=fail_fast,
+                cwd=cwd,
+                env=env,
+            )
+            logging.info('Exit code is %d', returncode)
+            if returncode != 0 or not installed:
+                report_build_failure(returncode, output)
+            logging.info('Go was built in %s', goroot)
+
+def install_go(goroot_final, goroot, version, echo=None, mode='auto'):
+    with trace_span('install', goroot=goroot_final) as span:
+        if echo:
+            echo('mkdir -p "%s"' % goroot_final)
+        else:
+            mkdir_p(goroot_final)
+        dirs = ['src', 'bin', 'pkg', 'misc']
+        if version_tuple(version) < version_tuple(MIN_VERSION_WITHOUT_INCLUDE):
+            dirs.append('include')
+        if echo:
+            # The build tree is removed afterwards, so it is moved rather
+            # than copied (mv copies only across file systems).
+            dirs2 = ['"%s"' % os.path.join(goroot, d) for d in dirs]
+            echo('mv %s "%s"' % (' '.join(dirs2), goroot_final))
+        else:
+            if mode == 'auto':
+                mode = choose_install_mode(goroot_final, goroot)
+            logging.info('Installing Go to %s (install mode: %s)', goroot_final, mode)
+            span['mode'] = mode
+            for subdir in dirs:
+                src = os.path.join(goroot, subdir)
+                dst = os.path.join(goroot_final, subdir)
+                install_tree(src, dst, mode)
+        if version_tuple(version) >= version_tuple(MIN_VERSION_GOENV_REQUIRED):
+            # Copy go.env file to fix "go: GOPROXY list is not the empty string, but contains no entries".
+            # Disable dangerous settings.
+            goenv_src = os.path.join(goroot, 'go.env')
+            goenv_dst = os.path.join(goroot_final, 'go.env')
+            if echo:
+                echo('echo "Copying go.env file to %s, disabling dangerous settings"' % goroot_final)
+                echo(
+                    'sed -e "s/GOPROXY=.*/GOPROXY=direct/" -e "s/GOSUMDB=.*/GOSUMDB=off/" '
+                    '-e "s/GOTOOLCHAIN=.*/GOTOOLCHAIN=local/" -- "%s" > "%s"' % (goenv_src, goenv_dst)
+                )
+            else:
+                logging.info('Copying go.env file to %s', goroot_final)
+                with io.open(goenv_src) as f:
+                    goenv_content = f.read()
+                logging.info('Disabling dangerous settings in go.env')
+                goenv_content = re.sub(r'GOPROXY=\S*', 'GOPROXY=direct', goenv_content)
+                goenv_content = re.sub(r'GOSUMDB=\S*', 'GOSUMDB=off', goenv_content)
+                goenv_content = re.sub(r'GOTOOLCHAIN=\S*', 'GOTOOLCHAIN=local', goenv_content)
+                with io.open(goenv_dst, 'w', newline='\n') as f:
+                    f.write(goenv_content)
+        if echo:
+            echo('echo "Go was installed to %s"' % goroot_final)
+        else:
+            logging.info('Go was installed to %s', goroot_final)
+
+def build_race(
+    goroot,
+    echo=None,
+    jobs=None,
+    nice=None,
+    ionice=None,
+    progress=log_progress,
+    fail_fast=False,
+    gocache=None,
+):
+    with trace_span('race', goroot=goroot):
+        # See https://github.com/golang/go/issues/20512
+        go_binary = os.path.join(goroot, 'bin', 'go')
+        args = [go_binary, 'install', '-v', '-race']
+        if jobs:
+            args += ['-p', str(jobs)]
+        args = priority_prefix(nice, ionice, echo) + args + ['std']
+        if echo:
+            echo(limit_env_echo(jobs) + ' '.join(args))
+        else:
+            logging.info('Building Go race in %s', goroot)
+            env = limit_env(os.environ.copy(), jobs)
+            if gocache:
+                env['GOCACHE'] = gocache
+            (returncode, _, output) = run_build(
+                args,
+                progress=progress,
+                fail_fast=fail_fast,
+                env=env,
+            )
+            logging.info('Exit code is %d', returncode)
+            if returncode != 0:
+                report_build_failure(returncode, output)
+
+def get_from_cache_or_download(cache_root, version, tmp_dir, echo):
+    """ Emits getting the verified archive, returns its path in the script.
+
+    Other builds stream the archive through fetch_and_unpack instead.
+    """
     filename = get_filename(version)
-    if not echo and cache_root:
-        file_in_cache = os.path.join(cache_root, filename)
-        if os.path.isfile(file_in_cache):
-            test_checksum(file_in_cache, version)
-            logging.info('Reusing file from cache: %s', file_in_cache)
-            return file_in_cache
+    if cache_root:
+        # The script reuses the archive if it is in the cache and intact
+        # and downloads it into the cache otherwise. The caller holds
+        # the lock of the archive.
+        file_in_cache = '%s/%s' % (cache_root, filename)
+        download = '%s.download.$$' % file_in_cache
+        echo('if ! echo "%s  %s" | sha256sum --check --status - 2>/dev/null; then' % (VERSIONS[version], file_in_cache))
+        download_file(download, get_url(version), echo)
+        test_checksum(download, version, echo)
+        echo('mv -f "%s" "%s"' % (download, file_in_cache))
+        echo('fi')
+        return file_in_cache
     tmp_name = os.path.join(tmp_dir, filename)
     download_file(tmp_name, get_url(version), echo)
     test_checksum(tmp_name, version, echo)
-    if not echo and cache_root:
-        mkdir_p(cache_root)
-        shutil.move(tmp_name, file_in_cache)
-        logging.info('New file was added to cache: %s', file_in_cache)
-        return file_in_cache
-    else:
-        return tmp_name
+    return tmp_name
+
+def fetch_and_unpack(
+    cache_root,
+    version,
+    tmp_dir,
+    echo=None,
+    connections=1,
+    paranoid=False,
+    skip_dirs=(),
+):
+    """ Put verified sources of the version into tmp_dir/go.
+
+    Top-level directories in skip_dirs are not extracted.
+    """
+    with trace_span('fetch', version=version) as span:
+        if echo:
+            if cache_root:
+                echo_lock_entry(cache_root, get_filename(version), ECHO_ARCHIVE_FD, echo)
+            archive = get_from_cache_or_download(cache_root, version, tmp_dir, echo)
+            if cache_root:
+                echo('lock_entry -s %d' % ECHO_ARCHIVE_FD)
+            unpack_file(tmp_dir, archive, echo, skip_dirs)
+            if cache_root:
+                echo('exec %d>&-' % ECHO_ARCHIVE_FD)
+            return
+        filename = get_filename(version)
+        file_in_cache = None
+        lock = None
+        if cache_root:
+            file_in_cache = os.path.join(cache_root, filename)
+            lock = cache_lock(cache_root, filename, shared=True)
+            if not os.path.isfile(file_in_cache):
+                # Only one process downloads the archive, others wait for it.
+                lock.release()
+                lock = cache_lock(cache_root, filename)
+        try:
+            if file_in_cache and os.path.isfile(file_in_cache):
+                touch_entry(cache_root, filename)
+                logging.info('Reusing file from cache: %s', file_in_cache)
+                span['bytes'] = os.path.getsize(file_in_cache)
+                if file_in_cache in PREFETCHED:
+                    PREFETCHED.discard(file_in_cache)
+                    span['cache'] = 'prefetched'
+                else:
+                    span['cache'] = 'hit'
+                    count_metric(cache_root, 'gohere_archive_cache_requests_total', result='hit')
+                if not paranoid and is_verified(cache_root, file_in_cache, version):
+                    unpack_file(tmp_dir, file_in_cache, skip_dirs=skip_dirs)
+                    return
+                with open(file_in_cache, 'rb') as f:
+                    verify_and_unpack(f, version, tmp_dir, file_in_cache, skip_dirs=skip_dirs)
+                remember_verified(cache_root, file_in_cache, version)
+                return
+            url = get_url(version)
+            span['cache'] = 'miss'
+            if connections > 1:
+                # Ranged downloads land on disk first (next to the cached file,
+                # so that they can be resumed) and are verified while unpacking.
+                if file_in_cache:
+                    mkdir_p(cache_root)
+                    archive = file_in_cache + '.download'
+                else:
+                    archive = os.path.join(tmp_dir, filename)
+                download_file(archive, url, connections=connections)
+                try:
+                    with open(archive, 'rb') as f:
+                        span['bytes'] = verify_and_unpack(f, version, tmp_dir, archive, skip_dirs=skip_dirs)
+                except BaseException:
+                    os.remove(archive)
+                    raise
+                if file_in_cache:
+                    os.rename(archive, file_in_cache)
+            else:
+                request = urllib2.urlopen(url)
+                try:
+                    if file_in_cache:
+                        mkdir_p(cache_root)
+                        part_name = file_in_cache + '.part'
+                        try:
+                            with open(part_name, 'wb') as part:
+                                span['bytes'] = verify_and_unpack(request, version, tmp_dir, url, part, skip_dirs)
+                        except BaseException:
+                            os.remove(part_name)
+                            raise
+                        os.rename(part_name, file_in_cache)
+                    else:
+                        span['bytes'] = verify_and_unpack(request, version, tmp_dir, url, skip_dirs=skip_dirs)
+                finally:
+                    request.close()
+            if file_in_cache:
+                remember_verified(cache_root, file_in_cache, version)
+                touch_entry(cache_root, filename)
+                logging.info('New file was added to cache: %s', file_in_cache)
+                count_metric(cache_root, 'gohere_archive_cache_requests_total', result='miss')
+            count_metric(cache_root, 'gohere_downloaded_bytes_total', span['bytes'])
+        finally:
+            if lock is not None:
+                lock.release()
+
+def prepare_sources(
+    cache_root,
+    version,
+    tmp_dir,
+    echo=None,
+    connections=1,
+    paranoid=False,
+    source_cache=False,
+    test=None,
+):
+    """ Put patched sources of the version into tmp_dir/go.
+
+    With source_cache, patched trees are kept in cache_root and cloned.
+    They are complete, while other trees lack what only test needs.
+    """
+    with trace_span('sources', version=version) as span:
+        goroot_build = os.path.join(tmp_dir, 'go')
+        if echo or not cache_root or not source_cache:
+            fetch_and_unpack(
+                cache_root,
+                version,
+                tmp_dir,
+                echo,
+                connections,
+                paranoid,
+                unused_source_dirs(test),
+            )
+            patch_go(goroot_build, version, echo)
+            return goroot_build
+        name = 'sources/go%s-%s' % (version, patch_fingerprint(version))
+        tree = os.path.join(cache_root, name)
+        lock, hit = use_entry(
+            cache_root,
+            name,
+            lambda path: add_to_source_cache(cache_root, version, path, connections, paranoid),
+        )
+        try:
+            if hit:
+                logging.info('Reusing patched sources from %s', tree)
+            span['cache'] = 'hit' if hit else 'miss'
+            clone_tree(os.path.join(tree, 'go'), goroot_build)
+        finally:
+            lock.release()
+        return goroot_build
+
+def add_to_source_cache(cache_root, version, tree, connections, paranoid):
+    mkdir_p(os.path.dirname(tree))
+    staging = staging_dir(tree)
+    os.mkdir(staging)
+    try:
+        fetch_and_unpack(cache_root, version, staging, None, connections, paranoid)
+        patch_go(os.path.join(staging, 'go'), version)
+        os.rename(staging, tree)
+        logging.info('Patched sources were added to cache: %s', tree)
+    finally:
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+
+class Background(object):
+    """ Runs func(*args) in a thread; result() waits and returns its value.
+
+    Any exception of func, including SystemExit, is raised by result().
+    """
+
+    def __init__(self, func, *args):
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(func, args))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, func, args):
+        try:
+            self.value = func(*args)
+        except BaseException as e:
+            self.error = e
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+def bootstrap_chain(
+    cache_root,
+    version,
+    bootstrap_search='all',
+    bootstrap_goroots=(),
+    binary_bootstrap=False,
+):
+    """ Bootstrap versions needed to build the version, nearest first.
+
+    The chain stops where an available toolchain can be the bootstrap,
+    at a bootstrap which is already built in the cache or at one which
+    is installed from its binary release.
+    """
+    chain = []
+    while not find_bootstrap(cache_root, version, bootstrap_search, bootstrap_goroots):
+        bootstrap_version = is_build_with_go(version)
+        if not bootstrap_version:
+            break
+        chain.append(bootstrap_version)
+        subdir = 'go%s_bootstrap' % bootstrap_version
+        if cache_root and os.path.exists(os.path.join(cache_root, subdir)):
+            break
+        if binary_bootstrap and has_binary(bootstrap_version):
+            break
+        version = bootstrap_version
+    return chain
+
+def take_bootstrap(cache_root, version, found, pins):
+    """ GOROOT of the toolchain found by find_bootstrap, or None if it is gone.
+
+    Toolchains from the cache are pinned, so they are not pruned.
+    """
+    (goroot, found_version, entry) = found
+    if entry is not None:
+        lock, hit = use_entry(cache_root, entry)
+        pins.append(lock)
+        if not hit:
+            return None
+    logging.info('Using Go %s in %s as bootstrap for Go %s', found_version, goroot, version)
+    count_metric(cache_root, 'gohere_bootstrap_requests_total', result='found')
+    return goroot
+
+def download_verified(path, url, checksum, connections=1):
+    """ Download url to path, raising IOError unless its sha256 is checksum.
+
+    Returns the size of the file.
+    """
+    part_name = path + '.part'
+    try:
+        if connections > 1:
+            download_file(part_name, url, connections=connections)
+            observed_checksum = make_checksum(part_name)
+        else:
+            request = urllib2.urlopen(url)
+            with open(part_name, 'wb') as part:
+                reader = HashingReader(request, part)
+                reader.drain()
+            request.close()
+            observed_checksum = reader.hexdigest()
+        if observed_checksum != checksum:
+            raise IOError('Checksum of %s is bad' % url)
+    except BaseException:
+        if os.path.exists(part_name):
+            os.remove(part_name)
+        raise
+    os.rename(part_name, path)
+    return os.path.getsize(path)
+
+# Archives prefetched by this process, which are not cache hits when
+# they are unpacked, as prefetch_archive already counted them as misses.
+PREFETCHED = set()
+
+def prefetch_archive(cache_root, version, connections=1):
+    """ Download and verify the archive into the cache unless it is there. """
+    filename = get_filename(version)
+    file_in_cache = os.path.join(cache_root, filename)
+    if os.path.isfile(file_in_cache):
+        return
+    with trace_span('prefetch', version=version) as span, cache_lock(cache_root, filename):
+        if os.path.isfile(file_in_cache):
+            return
+        url = get_url(version)
+        span['bytes'] = download_verified(file_in_cache, url, VERSIONS[version], connections)
+        remember_verified(cache_root, file_in_cache, version)
+        touch_entry(cache_root, filename)
+        PREFETCHED.add(file_in_cache)
+        count_metric(cache_root, 'gohere_archive_cache_requests_total', result='miss')
+        count_metric(cache_root, 'gohere_downloaded_bytes_total', span['bytes'])
+        logging.info('Prefetched %s into the cache', url)
+
+def install_binary_bootstrap(cache_root, version, goroot, staging, connections=1, paranoid=False):
+    """ Install the official binary release of the version to goroot.
+
+    The archive is verified against BINARY_VERSIONS and unpacked into
+    the empty directory staging first.
+    """
+    filename = get_binary_filename(version)
+    checksum = BINARY_VERSIONS[filename]
+    url = DL_URL + filename
+    with trace_span('binary', version=version) as span:
+        if cache_root:
+            archive = os.path.join(cache_root, filename)
+
+            def download(path):
+                try:
+                    span['bytes'] = download_verified(path, url, checksum, connections)
+                except IOError as e:
+                    logging.error('Failed to download %s: %s', url, e)
+                    sys.exit(1)
+                remember_verified(cache_root, path, None, checksum)
+                count_metric(cache_root, 'gohere_downloaded_bytes_total', span['bytes'])
+                logging.info('New file was added to cache: %s', path)
+
+            lock, hit = use_entry(cache_root, filename, download)
+            try:
+                if hit and (paranoid or not is_verified(cache_root, archive, None, checksum)):
+                    if make_checksum(archive) != checksum:
+                        logging.error('Checksum of %s is bad', archive)
+                        sys.exit(1)
+                    remember_verified(cache_root, archive, None, checksum)
+                unpack_file(staging, archive)
+            finally:
+                lock.release()
+        else:
+            archive = os.path.join(staging, filename)
+            try:
+                span['bytes'] = download_verified(archive, url, checksum, connections)
+            except IOError as e:
+                logging.error('Failed to download %s: %s', url, e)
+                sys.exit(1)
+            unpack_file(staging, archive)
+        os.rename(os.path.join(staging, 'go'), goroot)
+        logging.info('Go %s binary release was installed to %s', version, goroot)
+
+class Prefetcher(object):
+    """ Prefetches archives of several versions in parallel. """
+
+    def __init__(self, cache_root, versions, connections=1):
+        logging.info('Prefetching Go %s', ', '.join(versions))
+        self.tasks = dict(
+            (version, Background(prefetch_archive, cache_root, version, connections))
+            for version in versions
+        )
+
+    def wait(self, version):
+        task = self.tasks.get(version)
+        if task is None:
+            return
+        try:
+            task.result()
+        except (Exception, SystemExit) as e:
+            # The archive is fetched again and the error is reported then.
+            logging.warning('Failed to prefetch Go %s: %s', version, e)
+
+GOCACHE_DIR = 'gocache'
+
+def gocache_name(version):
+    """ Cache entry with the GOCACHE shared by builds of the version series. """
+    return '%s/go%d.%d' % ((GOCACHE_DIR,) + version_tuple(version)[:2])
+
+def use_gocache(cache_root, version, pins):
+    """ Path of the shared GOCACHE for the version, pinned in pins. """
+    if version_tuple(version) < version_tuple(MIN_VERSION_GOCACHE):
+        return None
+    lock, _ = use_entry(cache_root, gocache_name(version), mkdir_p)
+    pins.append(lock)
+    gocache = os.path.join(cache_root, gocache_name(version))
+    logging.info('Using GOCACHE %s', gocache)
+    return gocache
+
+def goroot_cache_dir(cache_root, goroot, version, race, test):
+    key = {
+        'version': version,
+        'race': bool(race),
+        'test': bool(test),
+        'os': platform.system().lower(),
+        'arch': platform.machine().lower(),
+        'patches': patch_fingerprint(version),
+    }
+    if version_tuple(version) < version_tuple(MIN_VERSION_RELOCATABLE):
+        # GOROOT_FINAL is baked into old toolchains.
+        key['goroot'] = goroot
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_root, 'goroots', 'go%s-%s' % (version, digest[:16])), key
+
+def install_from_goroot_cache(cache_root, goroot, version, race, test):
+    cached, _ = goroot_cache_dir(cache_root, goroot, version, race, test)
+    lock, hit = use_entry(cache_root, 'goroots/' + os.path.basename(cached))
+    try:
+        if not hit:
+            return False
+        logging.info('Reusing built Go from %s', cached)
+        clone_tree(os.path.join(cached, 'go'), goroot)
+    finally:
+        lock.release()
+    logging.info('Go %s was installed to %s from cache', version, goroot)
+    return True
+
+def add_to_goroot_cache(cache_root, goroot, version, race, test):
+    cached, key = goroot_cache_dir(cache_root, goroot, version, race, test)
+
+    def create(path):
+        mkdir_p(os.path.dirname(path))
+        staging = staging_dir(path)
+        try:
+            clone_tree(goroot, os.path.join(staging, 'go'))
+            save_json(os.path.join(staging, 'info.json'), key)
+            os.rename(staging, path)
+            logging.info('Built Go was added to cache: %s', path)
+        finally:
+            if os.path.exists(staging):
+                shutil.rmtree(staging)
+
+    lock, _ = use_entry(cache_root, 'goroots/' + os.path.basename(cached), create)
+    lock.release()
 
-def make_goroot_bootstrap(cache_root, tmp_dir, echo=None, bootstrap_version=BOOTSTRAP_VERSION):
-    subdir = 'go%s_bootstrap' % bootstrap_version
-    if not echo and cache_root:
+def make_goroot_bootstrap(
+    cache_root,
+    tmp_dir,
+    echo=None,
+    bootstrap_version=BOOTSTRAP_VERSION,
+    pins=None,
+    **options
+):
+    with trace_span('bootstrap', version=bootstrap_version) as span:
+        # options are passed to gohere() building the bootstrap.
+        # The lock of a cached bootstrap is added to pins, so it is not
+        # pruned until the caller releases it.
+        subdir = 'go%s_bootstrap' % bootstrap_version
+        binary = not echo and options.get('binary_bootstrap') and has_binary(bootstrap_version)
+        if not echo and options.get('binary_bootstrap') and not binary:
+            logging.info('No pinned binary release of Go %s for this host', bootstrap_version)
+        if echo and cache_root:
+            # Like use_entry: the script checks for the bootstrap under
+            # the shared lock, builds it under the exclusive one if it
+            # is still missing then and keeps it locked shared while it
+            # runs, so it is not pruned.
+            goroot_bootstrap = '%s/%s' % (cache_root, subdir)
+            staging = '%s.staging.$$' % goroot_bootstrap
+            fd = ECHO_BOOTSTRAP_FDS[bootstrap_version]
+            echo_lock_entry(cache_root, subdir, fd, echo, shared=True)
+            echo('if [ ! -x "%s/bin/go" ]; then' % goroot_bootstrap)
+            echo('lock_entry -u %d' % fd)
+            echo('lock_entry %d' % fd)
+            echo('if [ ! -x "%s/bin/go" ]; then' % goroot_bootstrap)
+            gohere(
+                staging,
+                bootstrap_version,
+                cache_root,
+                race=False,
+                echo=echo,
+                **options
+            )
+            # Without flock another script may have finished it meanwhile.
+            echo('if [ -e "%s" ]; then rm -rf "%s"; else mv "%s" "%s"; fi' % (
+                goroot_bootstrap,
+                staging,
+                staging,
+                goroot_bootstrap,
+            ))
+            echo('fi')
+            echo('lock_entry -s %d' % fd)
+            echo('fi')
+            # The modification time tells cache_entries it was used.
+            echo('touch "%s"' % goroot_bootstrap)
+            return goroot_bootstrap
+        if echo or not cache_root:
+            goroot_bootstrap = os.path.join(tmp_dir, subdir)
+            span['cache'] = 'miss'
+            if binary:
+                staging = tempfile.mkdtemp(dir=tmp_dir)
+                install_binary_bootstrap(
+                    None,
+                    bootstrap_version,
+                    goroot_bootstrap,
+                    staging,
+                    options.get('connections', 1),
+                )
+                shutil.rmtree(staging)
+                return goroot_bootstrap
+            if not echo:
+                logging.info('Building Go bootstrap in %s', goroot_bootstrap)
+            gohere(
+                goroot_bootstrap,
+                bootstrap_version,
+                cache_root,
+                race=False,
+                echo=echo,
+                **options
+            )
+            if not echo:
+                logging.info('Go bootstrap was built in %s', goroot_bootstrap)
+            return goroot_bootstrap
         goroot_bootstrap = os.path.join(cache_root, subdir)
-        if os.path.exists(goroot_bootstrap):
+
+        def build(path):
+            # The bootstrap is built aside and renamed into place,
+            # so a bootstrap directory in the cache is always complete.
+            # make.bash runs it with GOROOT set, so moving it is fine.
+            staging = staging_dir(path)
+            if binary:
+                os.mkdir(staging)
+                try:
+                    install_binary_bootstrap(
+                        cache_root,
+                        bootstrap_version,
+                        path,
+                        staging,
+                        options.get('connections', 1),
+                        options.get('paranoid', False),
+                    )
+                finally:
+                    shutil.rmtree(staging)
+                span['binary'] = True
+                return
+            logging.info('Building Go bootstrap in %s', staging)
+            try:
+                gohere(
+                    staging,
+                    bootstrap_version,
+                    cache_root,
+                    race=False,
+                    **options
+                )
+                os.rename(staging, path)
+            finally:
+                if os.path.exists(staging):
+                    shutil.rmtree(staging)
+            logging.info('Go bootstrap was built in %s', path)
+
+        lock, hit = use_entry(cache_root, subdir, build)
+        if pins is not None:
+            pins.append(lock)
+        else:
+            lock.release()
+        if hit:
             logging.info('Reusing bootstrap Go from %s', goroot_bootstrap)
-            return goroot_bootstrap
-    else:
-        goroot_bootstrap = os.path.join(tmp_dir, subdir)
-    if not echo:
-        logging.info('Building Go bootstrap in %s', goroot_bootstrap)
-    gohere(goroot_bootstrap, bootstrap_version, cache_root, race=False, echo=echo)
-    if not echo:
-        logging.info('Go bootstrap was built in %s', goroot_bootstrap)
-    return goroot_bootstrap
+        span['cache'] = 'hit' if hit else 'miss'
+        if hit:
+            result = 'reused'
+        elif binary:
+            result = 'downloaded'
+        else:
+            result = 'built'
+        count_metric(cache_root, 'gohere_bootstrap_requests_total', result=result)
+        return goroot_bootstrap
 
 def gohere(
     goroot,
@@ -907,9 +3033,24 @@ def gohere(
     race=True,
     echo=None,
     echo_goroot=None,
+    echo_cache=None,
+    connections=1,
+    paranoid=False,
+    source_cache=False,
+    goroot_cache=False,
+    install_mode='auto',
+    jobs=None,
+    nice=None,
+    ionice=None,
+    fail_fast=False,
+    prefetcher=None,
+    bootstrap_search='all',
+    bootstrap_goroots=(),
+    binary_bootstrap=False,
+    gocache=False,
 ):
     if echo and not goroot:
-        deps = 'bash coreutils wget tar sed gcc make'
+        deps = 'bash coreutils grep wget tar sed gcc make'
         if version in RELOCATION_TYPE_42_VERSIONS:
             deps += ' patch'
         echo('#!/bin/bash')
@@ -921,6 +3062,18 @@ def gohere(
             echo('if [ -z ${1+x} ]; then echo "Provide future GOROOT as the first argument."; exit 1; fi')
             echo('if [[ "$1" =~ ^/ ]]; then goroot="$1"; else goroot="$PWD/$1"; fi')
             goroot = '${goroot}'
+        # The cache is the one of the machine running the script.
+        if echo_cache:
+            echo('cache="%s"' % echo_cache)
+        else:
+            echo('cache="${GOHERE_CACHE:-$HOME/.cache/gohere}"')
+        echo('mkdir -p "$cache/%s"' % LOCKS_DIR)
+        # Entries are locked like gohere does when flock (util-linux)
+        # is available, so runs sharing the cache wait for each other
+        # and gohere cache prune leaves entries in use alone.
+        echo('lock_entry() { if command -v flock > /dev/null; then flock "$@"; fi; }')
+        echo("trap 'rm -rf \"$cache\"/*.download.$$ \"$cache\"/*.staging.$$' EXIT")
+        cache_root = '${cache}'
     if not echo:
         goroot = os.path.abspath(goroot)
     if cache_root is None:
@@ -931,28 +3084,273 @@ def gohere(
     if not echo and os.path.exists(goroot):
         logging.error('%s already exists. Remove it manually', goroot)
         sys.exit(1)
-    goroot_bootstrap = None
-    with TempDir(echo, goroot) as tmp_dir:
-        bootstrap_version = is_build_with_go(version)
-        if bootstrap_version:
-            if not echo:
-                logging.info('Go bootstrap is needed for Go %s', version)
-            goroot_bootstrap = make_goroot_bootstrap(cache_root, tmp_dir, echo, bootstrap_version=bootstrap_version)
+    with trace_span('gohere', version=version, goroot=goroot) as span:
+        goroot_cache = goroot_cache and not echo and cache_root
+        if jobs is None and not echo:
+            jobs = cpu_budget()
+        if goroot_cache:
+            if install_from_goroot_cache(cache_root, goroot, version, race, test):
+                span['goroot_cache'] = 'hit'
+                return
+            span['goroot_cache'] = 'miss'
+        if prefetcher is None and not echo and cache_root:
+            # Archives of the whole bootstrap chain are fetched while
+            # the chain is being built.
+            chain = bootstrap_chain(
+                cache_root,
+                version,
+                bootstrap_search,
+                bootstrap_goroots,
+                binary_bootstrap,
+            )
+            versions = [
+                v for v in chain
+                if not os.path.exists(os.path.join(cache_root, 'go%s_bootstrap' % v))
+                and not (binary_bootstrap and has_binary(v))
+            ]
+            # The target is only worth prefetching while a bootstrap
+            # builds; otherwise it is streamed into the cache as it is
+            # unpacked.
+            if versions:
+                prefetcher = Prefetcher(cache_root, versions + [version], connections)
+
+        def get_sources():
+            if prefetcher is not None:
+                prefetcher.wait(version)
+            return prepare_sources(
+                cache_root,
+                version,
+                tmp_dir,
+                echo,
+                connections,
+                paranoid,
+                source_cache,
+                test=test,
+            )
+
+        goroot_bootstrap = None
+        with TempDir(echo, goroot) as tmp_dir, Pins() as pins:
+            bootstrap_version = is_build_with_go(version)
+            if bootstrap_version and not echo:
+                found = find_bootstrap(cache_root, version, bootstrap_search, bootstrap_goroots)
+                if found:
+                    goroot_bootstrap = take_bootstrap(cache_root, version, found, pins)
+            build_bootstrap = bootstrap_version and goroot_bootstrap is None
+            sources = None
+            if build_bootstrap and not echo:
+                # Unpack and patch the sources while the bootstrap builds.
+                sources = Background(get_sources)
+            if build_bootstrap:
+                if not echo:
+                    logging.info('Go bootstrap is needed for Go %s', version)
+                try:
+                    goroot_bootstrap = make_goroot_bootstrap(
+                        cache_root,
+                        tmp_dir,
+                        echo,
+                        bootstrap_version=bootstrap_version,
+                        connections=connections,
+                        paranoid=paranoid,
+                        source_cache=source_cache,
+                        install_mode=install_mode,
+                        jobs=jobs,
+                        nice=nice,
+                        ionice=ionice,
+                        fail_fast=fail_fast,
+                        prefetcher=prefetcher,
+                        bootstrap_search=bootstrap_search,
+                        bootstrap_goroots=bootstrap_goroots,
+                        binary_bootstrap=binary_bootstrap,
+                        gocache=gocache,
+                        pins=pins,
+                    )
+                except BaseException:
+                    # Do not remove tmp_dir under the running thread.
+                    if sources is not None:
+                        sources.thread.join()
+                    raise
+                if not echo:
+                    logging.info('Using Go bootstrap in %s', goroot_bootstrap)
+            if sources is not None:
+                goroot_build = sources.result()
+            else:
+                goroot_build = get_sources()
+            gocache_dir = None
+            if gocache and not echo and cache_root:
+                gocache_dir = use_gocache(cache_root, version, pins)
+            build_started = time.time()
+            build_go(
+                goroot,
+                goroot_build,
+                goroot_bootstrap,
+                test,
+                echo,
+                jobs,
+                nice,
+                ionice,
+                fail_fast=fail_fast,
+                gocache=gocache_dir,
+            )
+            install_go(goroot, goroot_build, version, echo, install_mode)
+            if race:
+                build_race(goroot, echo, jobs, nice, ionice, fail_fast=fail_fast, gocache=gocache_dir)
             if not echo:
-                logging.info('Using Go bootstrap in %s', goroot_bootstrap)
-        archive = get_from_cache_or_download(cache_root, version, tmp_dir, echo)
-        unpack_file(tmp_dir, archive, echo)
-        goroot_build = os.path.join(tmp_dir, 'go')
-        patch_go(goroot_build, version, echo)
-        build_go(goroot, goroot_build, goroot_bootstrap, test, echo)
-        install_go(goroot, goroot_build, version, echo)
-        if race:
-            build_race(goroot, echo)
-        if not echo:
-            logging.info('Go %s was built and installed to %s', version, goroot)
+                logging.info('Go %s was built and installed to %s', version, goroot)
+                observe_build(cache_root, version, time.time() - build_started)
+            if goroot_cache:
+                add_to_goroot_cache(cache_root, goroot, version, race, test)
+
+def batch_plan(
+    cache_root,
+    versions,
+    bootstrap_search='all',
+    bootstrap_goroots=(),
+    binary_bootstrap=False,
+):
+    """ Graph of builds needed to install the versions.
+
+    Nodes are ('bootstrap', version) and ('target', version), values are
+    lists of nodes they depend on. Bootstraps already in the cache and
+    nodes which can use an available toolchain need no bootstrap node.
+    Bootstraps installed from binary releases depend on nothing.
+    """
+    graph = {}
+    for version in versions:
+        node = ('target', version)
+        while node not in graph:
+            bootstrap_version = is_build_with_go(node[1])
+            subdir = 'go%s_bootstrap' % bootstrap_version
+            if (not bootstrap_version or
+                    (node[0] == 'bootstrap' and binary_bootstrap and has_binary(node[1])) or
+                    os.path.exists(os.path.join(cache_root, subdir)) or
+                    find_bootstrap(cache_root, node[1], bootstrap_search, bootstrap_goroots)):
+                graph[node] = []
+                break
+            dependency = ('bootstrap', bootstrap_version)
+            graph[node] = [dependency]
+            node = dependency
+    return graph
+
+def batch_install(
+    into,
+    versions,
+    cache_root,
+    test=None,
+    race=True,
+    workers=None,
+    jobs=None,
+    **options
+):
+    """ Installs the versions to into/go<version>.
+
+    Bootstraps shared by several versions are built once and independent
+    builds run concurrently. The CPU budget is split between workers;
+    the number of workers is limited by memory available. Other options
+    are passed to gohere(). Returns a dict from node to (status, seconds).
+    """
+    if not cache_root:
+        logging.error('Batch mode needs a cache to share bootstraps')
+        sys.exit(1)
+    for version in versions:
+        if version not in VERSIONS:
+            logging.error('Unknown version: %s', version)
+            sys.exit(1)
+    graph = batch_plan(
+        cache_root,
+        versions,
+        options.get('bootstrap_search', 'all'),
+        options.get('bootstrap_goroots', ()),
+        options.get('binary_bootstrap', False),
+    )
+    cpus = jobs or cpu_budget()
+    if workers is None:
+        workers = cpus
+        memory = memory_budget()
+        if memory is not None:
+            workers = min(workers, memory // BUILD_MEMORY)
+    workers = max(1, min(workers, len(graph)))
+    node_jobs = max(1, cpus // workers)
+    logging.info(
+        'Building %d nodes with %d workers of %d CPUs each',
+        len(graph), workers, node_jobs,
+    )
+    mkdir_p(into)
+    prefetcher = Prefetcher(
+        cache_root,
+        sorted(set(version for (_, version) in graph), key=version_tuple),
+        options.get('connections', 1),
+    )
+    done = queue.Queue()
+
+    def build(node):
+        (kind, version) = node
+        started = time.time()
+        status = 'ok'
+        try:
+            with trace_span('batch', kind=kind, version=version):
+                if kind == 'bootstrap':
+                    make_goroot_bootstrap(
+                        cache_root,
+                        None,
+                        bootstrap_version=version,
+                        jobs=node_jobs,
+                        prefetcher=prefetcher,
+                        **options
+                    )
+                else:
+                    goroot = os.path.join(into, 'go%s' % version)
+                    gohere(
+                        goroot,
+                        version,
+                        cache_root,
+                        test,
+                        race=race,
+                        jobs=node_jobs,
+                        prefetcher=prefetcher,
+                        **options
+                    )
+        except (Exception, SystemExit) as e:
+            logging.error('Building %s Go %s failed: %s', kind, version, e)
+            status = 'failed'
+        done.put((node, status, time.time() - started))
+
+    pending = dict((node, set(dependencies)) for (node, dependencies) in graph.items())
+    results = {}
+    running = 0
+    while pending or running:
+        ready = sorted(
+            (node for (node, dependencies) in pending.items() if not dependencies),
+            key=lambda node: (node[0] != 'bootstrap', version_tuple(node[1])),
+        )
+        for node in ready[:workers - running]:
+            del pending[node]
+            thread = threading.Thread(target=build, args=(node,))
+            thread.daemon = True
+            thread.start()
+            running += 1
+        (node, status, seconds) = done.get()
+        running -= 1
+        results[node] = (status, seconds)
+        if status == 'ok':
+            for dependencies in pending.values():
+                dependencies.discard(node)
+            continue
+        failed = set([node])
+        while failed:
+            blocked = [n for (n, dependencies) in pending.items() if dependencies & failed]
+            failed = set(blocked)
+            for n in blocked:
+                del pending[n]
+                results[n] = ('skipped', 0.0)
+    for (node, (status, seconds)) in sorted(
+        results.items(),
+        key=lambda item: (item[0][0] != 'bootstrap', version_tuple(item[0][1])),
+    ):
+        logging.info('%-9s Go %-22s %-7s %8.1fs', node[0], node[1], status, seconds)
+    return results
 
 def find_all_go_versions():
-    req = urllib2.urlopen('https://golang.org/dl/')
+    req = urllib2.urlopen(DL_URL)
     html = str(req.read())
     req.close()
     return set(
@@ -962,52 +3360,191 @@ def find_all_go_versions():
         if version_tuple(match.group(1)) >= version_tuple(MIN_VERSION_BUILT_WITH_GO)
     )
 
-def remote_checksum(version):
+def feed_checksums(opener, state, binaries=None):
+    """ Map versions to sha256 of source archives from the release feed.
+
+    The value is None if the feed lists the archive without a checksum.
+    The request is conditional on ETag and Last-Modified from state;
+    returns None if the feed has not changed since. Checksums of binary
+    releases of bootstrap versions are added to binaries if given.
+    """
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    response = opener.open(DL_URL + '?mode=json&include=all', headers)
+    body = response.read()
+    if response.status == 304:
+        return None
+    releases = json.loads(body.decode('utf-8'))
+    state['etag'] = response.getheader('ETag')
+    state['last_modified'] = response.getheader('Last-Modified')
+    checksums = {}
+    for release in releases:
+        for item in release.get('files', []):
+            filename = item.get('filename', '')
+            match = re.match(r'go([0-9.]+)\.[a-z0-9]+-[a-z0-9]+\.tar\.gz$', filename)
+            if binaries is not None and match and item.get('sha256'):
+                if match.group(1) in BINARY_BOOTSTRAP_VERSIONS:
+                    binaries[filename] = item['sha256']
+            match = re.match(r'go([0-9.]+)\.src\.tar\.gz$', filename)
+            if not match:
+                continue
+            version = match.group(1)
+            if version_tuple(version) >= version_tuple(MIN_VERSION_BUILT_WITH_GO):
+                checksums[version] = item.get('sha256') or None
+    return checksums
+
+def remote_checksum(version, opener=None):
     logging.info('Getting checksum of Go %s', version)
-    req = urllib2.urlopen(get_url(version))
+    if opener is None:
+        req = urllib2.urlopen(get_url(version))
+    else:
+        req = opener.open(get_url(version))
     value = checksum_of_file(req)
     req.close()
     return value
 
-def find_checksums(versions):
-    return {
-        version: remote_checksum(version)
-        for version in versions
-    }
+def find_checksums(versions, opener=None, jobs=4):
+    # Workers reuse their connections through the shared opener.
+    versions = sorted(versions, key=version_tuple)
+    if opener is None:
+        opener = KeepAliveOpener()
+    pool = ThreadPool(jobs)
+    try:
+        checksums = pool.map(lambda version: remote_checksum(version, opener), versions)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(versions, checksums))
 
-def update_versions():
-    all_go_versions = find_all_go_versions()
-    # parse this file
-    this_file = sys.argv[0]
-    with open(this_file) as f:
-        this_file_content = f.read()
-    sep1 = 'VERSIONS = {'
+UPDATE_STATE = 'update-state.json'
+
+def find_new_checksums(known_versions, state=None, binaries=None):
+    """ Checksums of versions missing from known_versions.
+
+    They are taken from the JSON release feed where possible; other
+    archives are downloaded and hashed. state keeps validators of the
+    feed and checksums of hashed archives between runs. binaries is
+    passed to feed_checksums.
+    """
+    if state is None:
+        state = {}
+    probed = state.setdefault('probed', {})
+    opener = KeepAliveOpener()
+    try:
+        checksums = feed_checksums(opener, state, binaries)
+        if checksums is None:
+            logging.info('The release feed has not changed')
+            return {}
+    except (IOError, ValueError) as e:
+        logging.warning('Failed to use the release feed: %s', e)
+        state.pop('etag', None)
+        state.pop('last_modified', None)
+        checksums = dict.fromkeys(find_all_go_versions())
+    checksums = dict(
+        (version, checksum or probed.get(version))
+        for (version, checksum) in checksums.items()
+        if version not in known_versions
+    )
+    missing = [version for (version, checksum) in checksums.items() if not checksum]
+    if missing:
+        hashed = find_checksums(missing, opener)
+        probed.update(hashed)
+        checksums.update(hashed)
+    return checksums
+
+def tables_digest(versions, binaries):
+    # The table names keep digests of states saved before BINARY_VERSIONS
+    # existed from matching while it is empty.
+    text = json.dumps([
+        ['VERSIONS', sorted(versions.items())],
+        ['BINARY_VERSIONS', sorted(binaries.items())],
+    ])
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def split_table(content, name):
+    """ (prefix, entries, suffix) of the dict literal name in content. """
+    sep1 = '\n%s = {' % name
     sep2 = '}'
-    (prefix, other) = this_file_content.split(sep1, 1)
-    (known_versions_text, suffix) = other.split(sep2, 1)
-    known_versions = {
-        match.group(1): match.group(2)
+    (prefix, other) = content.split(sep1, 1)
+    (text, suffix) = other.split(sep2, 1)
+    entries = dict(
+        (match.group(1), match.group(2))
         for match
-        in re.finditer(r"'([0-9a-z.-]+)': '([0-9a-f]+)'", known_versions_text)
-    }
-    new_go_versions = set(all_go_versions) - set(known_versions)
-    known_versions.update(find_checksums(new_go_versions))
-    known_versions = sorted(
-        known_versions.items(),
-        key=lambda kv: version_tuple(kv[0]),
+        in re.finditer(r"'([0-9a-z.-]+)': '([0-9a-f]+)'", text)
     )
-    versions_text = '\n'.join(
-        "    '%s': '%s'," % (version, checksum)
-        for (version, checksum)
-        in known_versions
+    return (prefix + sep1, entries, sep2 + suffix)
+
+def format_table(entries, key):
+    return ''.join(
+        "\n    '%s': '%s'," % (name, checksum)
+        for (name, checksum)
+        in sorted(entries.items(), key=lambda kv: key(kv[0]))
+    ) + '\n'
+
+def update_tables(this_file_content, state):
+    """ this_file_content with new checksums added, or None if no new ones.
+
+    state is the update state, changed in place.
+    """
+    (_, known_versions, _) = split_table(this_file_content, 'VERSIONS')
+    (_, known_binaries, _) = split_table(this_file_content, 'BINARY_VERSIONS')
+    digest = tables_digest(known_versions, known_binaries)
+    if state.get('versions') != digest:
+        # The lists were changed since the last run, the feed must be
+        # compared with them again.
+        state.pop('etag', None)
+        state.pop('last_modified', None)
+    binaries = dict(known_binaries)
+    new_versions = find_new_checksums(known_versions, state, binaries)
+    known_versions.update(new_versions)
+    state['versions'] = tables_digest(known_versions, binaries)
+    state['probed'] = dict(
+        (version, checksum)
+        for (version, checksum) in state.get('probed', {}).items()
+        if version not in known_versions
     )
-    with open(this_file, 'wt') as f:
-        f.write(prefix + sep1 + '\n' + versions_text + '\n' + sep2 + suffix)
+    if not new_versions and binaries == known_binaries:
+        return None
+    if new_versions:
+        logging.info('New Go versions: %s', ', '.join(sorted(new_versions, key=version_tuple)))
+    new_binaries = sorted(set(binaries) - set(known_binaries))
+    if new_binaries:
+        logging.info('New binary releases: %s', ', '.join(new_binaries))
+    (prefix, _, suffix) = split_table(this_file_content, 'VERSIONS')
+    content = prefix + format_table(known_versions, version_tuple) + suffix
+    (prefix, _, suffix) = split_table(content, 'BINARY_VERSIONS')
+    return prefix + format_table(binaries, str) + suffix
+
+def update_versions(cache_root=None):
+    state_path = None
+    state = {}
+    if cache_root:
+        state_path = os.path.join(cache_root, UPDATE_STATE)
+        state = load_json(state_path, {})
+    # parse this file
+    this_file = sys.argv[0]
+    with open(this_file) as f:
+        this_file_content = f.read()
+    content = update_tables(this_file_content, state)
+    if content is not None:
+        with open(this_file, 'wt') as f:
+            f.write(content)
+    else:
+        logging.info('No new Go versions, %s is not changed', this_file)
+    if state_path:
+        mkdir_p(cache_root)
+        save_json(state_path, state)
 
 def printer(x):
     print(x)
 
 def main():
+    if sys.argv[1:2] == ['cache']:
+        cache_main(sys.argv[2:])
+        return
     parser = argparse.ArgumentParser(
         description=__doc__,
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -1019,38 +3556,155 @@ def main():
         help='Root of Go',
         nargs='?',
     )
+    group.add_argument(
+        '--versions',
+        type=str,
+        nargs='+',
+        help='Install these Go versions to --into in one batch',
+    )
     group.add_argument(
         '--update-versions',
         action='store_true',
         help='Update list of Go verions instead of normal operation',
     )
+    group.add_argument(
+        '--metrics',
+        action='store_true',
+        help='Print metrics collected in the cache in Prometheus text format',
+    )
     group.add_argument(
         '--echo',
         action='store_true',
         help='Produce shell code instead',
     )
+    parser.add_argument(
+        '--into',
+        type=str,
+        help='Directory for --versions, each version goes to go<version>',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Concurrent builds for --versions (default: fit into CPUs and memory)',
+    )
     parser.add_argument(
         '--echo-goroot',
         type=str,
         help='Hardcoded GOROOT for --echo',
     )
+    parser.add_argument(
+        '--echo-cache',
+        type=str,
+        help='Hardcoded cache for --echo (default: $GOHERE_CACHE or ~/.cache/gohere where the script runs)',
+    )
     parser.add_argument(
         '--version',
         type=str,
         help='Go version',
         default=max(VERSIONS, key=version_tuple),
     )
+    parser.add_argument(
+        '--mirror',
+        type=str,
+        help='Base URL of a mirror of %s' % DL_URL,
+    )
     parser.add_argument(
         '--cache',
         type=str,
         help='Cache for downloaded Go sources',
         default=get_default_cache(),
     )
+    parser.add_argument(
+        '--cache-max-size',
+        type=str,
+        help='Prune least recently used cache entries down to this size, e.g. 20G',
+    )
+    parser.add_argument(
+        '--connections',
+        type=int,
+        help='Download archives over this many parallel ranged connections',
+        default=1,
+    )
+    parser.add_argument(
+        '--paranoid',
+        action='store_true',
+        help='Rehash cached archives even if they were verified before',
+    )
+    parser.add_argument(
+        '--source-cache',
+        action='store_true',
+        help='Keep patched source trees in the cache and clone them',
+    )
+    parser.add_argument(
+        '--goroot-cache',
+        action='store_true',
+        help='Keep built toolchains in the cache and install from there',
+    )
+    parser.add_argument(
+        '--gocache',
+        action='store_true',
+        help='Share a GOCACHE in the cache between builds of the same Go series',
+    )
+    parser.add_argument(
+        '--install-mode',
+        type=str,
+        choices=INSTALL_MODES,
+        default='auto',
+        help='How to move the built tree into GOROOT',
+    )
+    parser.add_argument(
+        '--bootstrap-search',
+        type=str,
+        choices=BOOTSTRAP_SEARCH,
+        default='all',
+        help='Where to look for a toolchain to use as the bootstrap: '
+             'everywhere (cache, --bootstrap-goroot, GOROOT_BOOTSTRAP, PATH), '
+             'only in the cache, or nowhere (always build the chain)',
+    )
+    parser.add_argument(
+        '--bootstrap-goroot',
+        type=str,
+        action='append',
+        default=[],
+        help='GOROOT of an installed Go to consider as the bootstrap (repeatable)',
+    )
+    parser.add_argument(
+        '--binary-bootstrap',
+        action='store_true',
+        help='Install bootstraps from official binary releases pinned in BINARY_VERSIONS '
+             'instead of building them',
+    )
     parser.add_argument(
         '--test',
         action='store_true',
         help='Enable Go tests (takes several minutes to complete)',
     )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        help='CPUs used by builds, set as GOMAXPROCS of make.bash and -p of the race build (default: CPUs available, honoring cgroup limits)',
+    )
+    parser.add_argument(
+        '--nice',
+        type=int,
+        help='Run builds with this niceness',
+    )
+    parser.add_argument(
+        '--ionice',
+        type=str,
+        choices=sorted(IONICE_CLASSES),
+        help='Run builds with this I/O scheduling class',
+    )
+    parser.add_argument(
+        '--fail-fast',
+        action='store_true',
+        help='Stop the build on the first failing test or package',
+    )
+    parser.add_argument(
+        '--trace',
+        type=str,
+        help='Write a Chrome trace of the phases of the run to this file',
+    )
     parser.add_argument(
         '--race',
         type=str,
@@ -1060,8 +3714,19 @@ def main():
     )
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG)
+    cache_max_size = None
+    if args.cache_max_size:
+        try:
+            cache_max_size = parse_size(args.cache_max_size)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.mirror:
+        set_mirror(args.mirror)
     if args.update_versions:
-        update_versions()
+        update_versions(args.cache)
+        return
+    if args.metrics:
+        print(format_metrics(args.cache))
         return
     if args.race == 'auto':
         race = (platform.system() != 'Windows')
@@ -1073,15 +3738,71 @@ def main():
     echo = args.echo
     if echo:
         echo = printer
-    gohere(
-        goroot,
-        args.version,
-        args.cache,
-        args.test,
-        race=race,
-        echo=echo,
-        echo_goroot=args.echo_goroot,
-    )
+    global TRACER
+    if args.trace:
+        TRACER = Tracer()
+    if args.versions:
+        if not args.into:
+            parser.error('--versions requires --into')
+        try:
+            results = batch_install(
+                args.into,
+                args.versions,
+                args.cache,
+                args.test,
+                race=race,
+                workers=args.workers,
+                jobs=args.jobs,
+                connections=args.connections,
+                paranoid=args.paranoid,
+                source_cache=args.source_cache,
+                goroot_cache=args.goroot_cache,
+                install_mode=args.install_mode,
+                nice=args.nice,
+                ionice=args.ionice,
+                fail_fast=args.fail_fast,
+                bootstrap_search=args.bootstrap_search,
+                bootstrap_goroots=args.bootstrap_goroot,
+                binary_bootstrap=args.binary_bootstrap,
+                gocache=args.gocache,
+            )
+        finally:
+            if args.trace:
+                TRACER.save(args.trace)
+        if cache_max_size is not None:
+            prune_cache(args.cache, cache_max_size)
+        if any(status != 'ok' for (status, _) in results.values()):
+            sys.exit(1)
+        return
+    try:
+        gohere(
+            goroot,
+            args.version,
+            args.cache,
+            args.test,
+            race=race,
+            echo=echo,
+            echo_goroot=args.echo_goroot,
+            echo_cache=args.echo_cache,
+            connections=args.connections,
+            paranoid=args.paranoid,
+            source_cache=args.source_cache,
+            goroot_cache=args.goroot_cache,
+            install_mode=args.install_mode,
+            jobs=args.jobs,
+            nice=args.nice,
+            ionice=args.ionice,
+            fail_fast=args.fail_fast,
+            bootstrap_search=args.bootstrap_search,
+            bootstrap_goroots=args.bootstrap_goroot,
+            binary_bootstrap=args.binary_bootstrap,
+            gocache=args.gocache,
+        )
+    finally:
+        if args.trace:
+            TRACER.save(args.trace)
+    if cache_max_size is not None and not echo:
+        prune_cache(args.cache, cache_max_size)
 
 if __name__ == '__main__':
     main()
@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 
+import hashlib
+import io
+import json
 import logging
 import os
 import platform
+import re
 import shutil
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
 
 import gohere
 
@@ -49,6 +63,411 @@ def test_installation(version, goroot, gopath, race1):
     args = [hello_binary]
     run(args)
 
+class StandInHandler(BaseHTTPRequestHandler):
+    # Serves self.server.files, honoring Range if self.server.ranges.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.sha256(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range') or '')
+        if match and self.server.ranges:
+            start, end = int(match.group(1)), int(match.group(2)) + 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, len(data)))
+            data = data[start:end]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_stand_in(files, ranges=True):
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    server.files = files
+    server.ranges = ranges
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+def test_ranged_download():
+    data = os.urandom(3 * gohere.DOWNLOAD_PIECE_SIZE + 12345)
+    tmp = tempfile.mkdtemp()
+    for ranges in (True, False):
+        server, base = start_stand_in({'/go.tar.gz': data}, ranges)
+        destination = os.path.join(tmp, 'go.tar.gz')
+        if ranges:
+            # A piece left by an interrupted download is resumed.
+            end = gohere.DOWNLOAD_PIECE_SIZE
+            with open('%s.part-0-%d' % (destination, end), 'wb') as f:
+                f.write(data[:1000])
+        gohere.download_file(destination, base + '/go.tar.gz', connections=3)
+        with open(destination, 'rb') as f:
+            assert f.read() == data
+        assert os.listdir(tmp) == ['go.tar.gz']
+        os.remove(destination)
+        server.shutdown()
+    shutil.rmtree(tmp)
+
+def test_update_checksums():
+    archive = os.urandom(1000)
+    feed = [
+        {'files': [
+            {'filename': 'go1.98.src.tar.gz', 'sha256': 'ab' * 32},
+            {'filename': 'go1.98.linux-amd64.tar.gz', 'sha256': 'cd' * 32},
+        ]},
+        {'files': [{'filename': 'go1.99.src.tar.gz'}]},
+        {'files': [{'filename': 'go1.5.src.tar.gz', 'sha256': 'ef' * 32}]},
+    ]
+    server, base = start_stand_in({
+        '/?mode=json&include=all': json.dumps(feed).encode(),
+        '/go1.99.src.tar.gz': archive,
+    })
+    old_url = gohere.DL_URL
+    gohere.set_mirror(base)
+    state = {}
+    try:
+        checksums = gohere.find_new_checksums({'1.5': 'ef' * 32}, state)
+        # The unchanged feed is not downloaded again.
+        assert gohere.find_new_checksums({'1.5': 'ef' * 32}, state) == {}
+    finally:
+        gohere.DL_URL = old_url
+        server.shutdown()
+    assert checksums == {
+        '1.98': 'ab' * 32,
+        '1.99': hashlib.sha256(archive).hexdigest(),
+    }
+    assert state['probed'] == {'1.99': hashlib.sha256(archive).hexdigest()}
+
+def test_update_from_old_state():
+    # State saved before BINARY_VERSIONS existed must not keep the feed
+    # validators, or the unchanged feed is never read for binaries.
+    binary = 'go%s.linux-amd64.tar.gz' % gohere.BOOTSTRAP_VERSION_1_22_12
+    feed = json.dumps([{'files': [
+        {'filename': 'go1.5.src.tar.gz', 'sha256': 'ef' * 32},
+        {'filename': binary, 'sha256': 'ab' * 32},
+    ]}]).encode()
+    content = "\nVERSIONS = {\n    '1.5': '%s',\n}\nBINARY_VERSIONS = {\n}\n" % ('ef' * 32)
+    state = {
+        'versions': hashlib.sha256(json.dumps([['1.5', 'ef' * 32]]).encode()).hexdigest(),
+        'etag': '"%s"' % hashlib.sha256(feed).hexdigest(),
+    }
+    server, base = start_stand_in({'/?mode=json&include=all': feed})
+    old_url = gohere.DL_URL
+    gohere.set_mirror(base)
+    try:
+        content = gohere.update_tables(content, state)
+        # Now the unchanged feed is not downloaded again.
+        assert gohere.update_tables(content, state) is None
+    finally:
+        gohere.DL_URL = old_url
+        server.shutdown()
+    (_, binaries, _) = gohere.split_table(content, 'BINARY_VERSIONS')
+    assert binaries == {binary: 'ab' * 32}
+
+def test_binary_bootstrap():
+    if gohere.binary_platform() is None:
+        return
+    version = gohere.BOOTSTRAP_VERSION_1_22_12
+    go = ('#!/bin/sh\necho "go version go%s %s"\n' % (version, gohere.binary_platform())).encode()
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        info = tarfile.TarInfo('go/bin/go')
+        info.size = len(go)
+        info.mode = 0o755
+        tar.addfile(info, io.BytesIO(go))
+    archive = buf.getvalue()
+    filename = gohere.get_binary_filename(version)
+    feed = [{'files': [{'filename': filename, 'sha256': hashlib.sha256(archive).hexdigest()}]}]
+    server, base = start_stand_in({
+        '/' + filename: archive,
+        '/?mode=json&include=all': json.dumps(feed).encode(),
+    })
+    old_url = gohere.DL_URL
+    old_binaries = dict(gohere.BINARY_VERSIONS)
+    gohere.set_mirror(base)
+    cache = tempfile.mkdtemp()
+    try:
+        binaries = {}
+        gohere.find_new_checksums(gohere.VERSIONS, {}, binaries)
+        assert binaries == {filename: hashlib.sha256(archive).hexdigest()}
+        gohere.BINARY_VERSIONS.update(binaries)
+        for _ in range(2):
+            goroot = gohere.make_goroot_bootstrap(
+                cache,
+                None,
+                bootstrap_version=version,
+                binary_bootstrap=True,
+            )
+            assert gohere.toolchain_version(goroot) == version
+        # A bad pinned checksum is refused.
+        gohere.BINARY_VERSIONS[filename] = 'ab' * 32
+        try:
+            gohere.make_goroot_bootstrap(
+                tempfile.mkdtemp(),
+                None,
+                bootstrap_version=version,
+                binary_bootstrap=True,
+            )
+            assert False, 'bad binary was accepted'
+        except SystemExit:
+            pass
+    finally:
+        gohere.DL_URL = old_url
+        gohere.BINARY_VERSIONS.clear()
+        gohere.BINARY_VERSIONS.update(old_binaries)
+        server.shutdown()
+        shutil.rmtree(cache)
+
+def test_selective_extraction():
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name in ['go/VERSION', 'go/src/make.bash', 'go/src/go/doc/doc.go', 'go/test/x.go', 'go/api/go1.txt']:
+            info = tarfile.TarInfo(name)
+            info.size = len(name)
+            tar.addfile(info, io.BytesIO(name.encode()))
+    for test in (False, True):
+        tmp = tempfile.mkdtemp()
+        buf.seek(0)
+        gohere.extract_stream(buf, tmp, skip_dirs=gohere.unused_source_dirs(test))
+        names = set(os.path.relpath(os.path.join(d, f), tmp) for (d, _, files) in os.walk(tmp) for f in files)
+        expected = set(['go/VERSION', 'go/src/make.bash', 'go/src/go/doc/doc.go'])
+        if test:
+            expected |= set(['go/test/x.go', 'go/api/go1.txt'])
+        assert names == set(os.path.normpath(name) for name in expected), names
+        shutil.rmtree(tmp)
+
+def test_unsafe_links():
+    outside = tempfile.mkdtemp()
+    links = [
+        ('go/x', tarfile.SYMTYPE, outside),
+        ('go/x', tarfile.SYMTYPE, '../../' + os.path.basename(outside)),
+        ('go/x', tarfile.LNKTYPE, '../' + os.path.basename(outside)),
+    ]
+    for (name, kind, target) in links:
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            info.linkname = target
+            tar.addfile(info)
+            info = tarfile.TarInfo('go/x/pwned')
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b'x'))
+        buf.seek(0)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(outside))
+        try:
+            gohere.extract_stream(buf, tmp)
+            assert False, 'link out of the directory was accepted'
+        except Exception as e:
+            assert 'Path Traversal' in str(e), e
+        assert os.listdir(outside) == []
+        shutil.rmtree(tmp)
+    shutil.rmtree(outside)
+
+def test_prune_cache():
+    cache = tempfile.mkdtemp()
+    now = time.time()
+    files = [
+        ('go1.98.src.tar.gz', '', b'a' * 1000, now - 4000),
+        ('go1.96_bootstrap', 'bin/go', b'b' * 2000, now - 3000),
+        ('go1.97.src.tar.gz', '', b'c' * 1000, now - 2000),
+        ('gocache/go1.96', 'x', b'd' * 1000, now - 1000),
+        ('go0.0.src.tar.gz', '', b'e' * 500, now),
+    ]
+    names = []
+    for (name, inner, data, used) in files:
+        entry = os.path.join(cache, name)
+        path = os.path.join(entry, inner) if inner else entry
+        gohere.mkdir_p(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(entry, (used, used))
+        names.append(name)
+    old_versions = dict(gohere.VERSIONS)
+    gohere.VERSIONS['1.98'] = hashlib.sha256(b'a' * 1000).hexdigest()
+    gohere.VERSIONS['1.97'] = hashlib.sha256(b'x').hexdigest()
+    try:
+        statuses = dict((entry['name'], status) for (entry, status) in gohere.verify_cache(cache))
+    finally:
+        gohere.VERSIONS.clear()
+        gohere.VERSIONS.update(old_versions)
+    assert statuses == {
+        'go1.98.src.tar.gz': 'ok',
+        'go1.97.src.tar.gz': 'bad',
+        'go0.0.src.tar.gz': 'unknown',
+    }, statuses
+    entries = gohere.cache_entries(cache)
+    assert [entry['name'] for entry in entries] == names
+    total = sum(entry['size'] for entry in entries)
+    assert total == 5500
+    # The bootstrap is in use, the newest archive is in the grace period.
+    lock = gohere.cache_lock(cache, 'go1.96_bootstrap', shared=True)
+    try:
+        removed = gohere.prune_cache(cache, total - 1500)
+        assert [entry['name'] for entry in removed] == [names[0], names[2]]
+        removed = gohere.prune_cache(cache, 0)
+        assert [entry['name'] for entry in removed] == [names[3]]
+    finally:
+        lock.release()
+    assert [entry['name'] for entry in gohere.cache_entries(cache)] == [names[1], names[4]]
+    shutil.rmtree(cache)
+
+def test_parse_size():
+    assert gohere.parse_size('100') == 100
+    assert gohere.parse_size('500M') == 500 * 1024 ** 2
+    assert gohere.parse_size('1.5G') == 3 * 512 * 1024 ** 2
+    assert gohere.parse_size('20GiB') == gohere.parse_size('20gb') == 20 * 1024 ** 3
+    try:
+        gohere.parse_size('20X')
+        assert False, 'bad size was accepted'
+    except ValueError:
+        pass
+
+def test_find_bootstrap():
+    if os.name == 'nt':
+        return
+    cache = tempfile.mkdtemp()
+    for version in ['1.17.13', '1.20.14', '1.22.12', '1.23.0', '1.25.5']:
+        go = os.path.join(cache, 'go%s_bootstrap' % version, 'bin', 'go')
+        gohere.mkdir_p(os.path.dirname(go))
+        with open(go, 'w') as f:
+            f.write('#!/bin/sh\necho "go version go%s linux/amd64"\n' % version)
+        os.chmod(go, 0o755)
+    # The oldest toolchain between the minimum bootstrap and the version.
+    for (version, expected) in [
+        ('1.24.11', '1.22.12'),
+        ('1.22.12', '1.20.14'),
+        ('1.21.13', '1.17.13'),
+        ('1.5.4', None),
+    ]:
+        found = gohere.find_bootstrap(cache, version, 'cache')
+        if expected is None:
+            assert found is None, found
+        else:
+            entry = 'go%s_bootstrap' % expected
+            assert found == (os.path.join(cache, entry), expected, entry), found
+    assert gohere.find_bootstrap(cache, '1.24.11', 'none') is None
+    shutil.rmtree(cache)
+
+def test_batch_install():
+    cache = tempfile.mkdtemp()
+    into = tempfile.mkdtemp()
+    bootstrap = gohere.BOOTSTRAP_VERSION
+    graph = gohere.batch_plan(cache, ['1.5.4', '1.21.13', '1.25.5'], 'none')
+    assert graph == {
+        ('target', '1.5.4'): [('bootstrap', bootstrap)],
+        ('target', '1.21.13'): [('bootstrap', '1.17.13')],
+        ('target', '1.25.5'): [('bootstrap', '1.22.12')],
+        ('bootstrap', '1.22.12'): [('bootstrap', '1.20.14')],
+        ('bootstrap', '1.20.14'): [('bootstrap', '1.17.13')],
+        ('bootstrap', '1.17.13'): [('bootstrap', bootstrap)],
+        ('bootstrap', bootstrap): [],
+    }, graph
+    built = []
+
+    def make_goroot_bootstrap(cache_root, tmp_dir, bootstrap_version, **options):
+        built.append(('bootstrap', bootstrap_version))
+        if bootstrap_version == '1.20.14':
+            raise Exception('build failed')
+
+    def fake_gohere(goroot, version, *args, **options):
+        built.append(('target', version))
+
+    stubs = {
+        'make_goroot_bootstrap': make_goroot_bootstrap,
+        'gohere': fake_gohere,
+        'prefetch_archive': lambda *args: None,
+    }
+    originals = dict((name, getattr(gohere, name)) for name in stubs)
+    for (name, stub) in stubs.items():
+        setattr(gohere, name, stub)
+    try:
+        results = gohere.batch_install(
+            into,
+            ['1.5.4', '1.21.13', '1.25.5'],
+            cache,
+            workers=1,
+            bootstrap_search='none',
+        )
+    finally:
+        for (name, original) in originals.items():
+            setattr(gohere, name, original)
+    # Bootstraps go first, and nothing is built on top of a failed one.
+    assert built == [
+        ('bootstrap', bootstrap),
+        ('bootstrap', '1.17.13'),
+        ('bootstrap', '1.20.14'),
+        ('target', '1.5.4'),
+        ('target', '1.21.13'),
+    ], built
+    statuses = dict((node, status) for (node, (status, _)) in results.items())
+    assert statuses == {
+        ('bootstrap', bootstrap): 'ok',
+        ('bootstrap', '1.17.13'): 'ok',
+        ('bootstrap', '1.20.14'): 'failed',
+        ('bootstrap', '1.22.12'): 'skipped',
+        ('target', '1.25.5'): 'skipped',
+        ('target', '1.5.4'): 'ok',
+        ('target', '1.21.13'): 'ok',
+    }, statuses
+    shutil.rmtree(cache)
+    shutil.rmtree(into)
+
+def test_hunk_offset():
+    diff = gohere.Patch('''
+--- a.c
++++ a.c
+@@ -2,3 +2,4 @@
+ b
+ c
++c2
+ d
+@@ -10,2 +11,3 @@
+ j
++j2
+ k
+''', '').file_patches[0]
+    source = [chr(ord('a') + i) for i in range(12)]
+    # The drift found by the first hunk carries over to the second one.
+    shifted = ['x'] * 5 + source
+    patched = diff.patch_text('\n'.join(shifted) + '\n').splitlines()
+    assert patched == ['x'] * 5 + source[:3] + ['c2'] + source[3:10] + ['j2'] + source[10:]
+    too_far = ['x'] * (gohere.MAX_HUNK_OFFSET + 1) + source
+    try:
+        diff.patch_text('\n'.join(too_far) + '\n')
+        assert False, 'hunk was applied too far from its line'
+    except gohere.PatchError:
+        pass
+
+test_ranged_download()
+test_hunk_offset()
+test_selective_extraction()
+test_unsafe_links()
+test_prune_cache()
+test_parse_size()
+test_find_bootstrap()
+test_batch_install()
+test_update_checksums()
+test_update_from_old_state()
+test_binary_bootstrap()
+
 for version in sorted(gohere.VERSIONS, key=gohere.version_tuple):
     if not latestMajor(version):
         continue